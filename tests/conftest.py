@@ -0,0 +1,71 @@
+
+import asyncio
+import json
+import os
+import httpx
+import pytest
+
+
+from uiautomator2Async import AsyncDevice
+
+
+DUMPS = os.path.join(os.path.dirname(__file__), 'dumps')
+
+
+
+class FakeAgent(object) :
+    """
+    atx-agent over httpx.MockTransport, answers from dumps/settings.xml
+
+    Override rpc() to change a JSON-RPC answer, calls lists the requests
+    """
+
+    def __init__(self, dump: str = 'settings.xml', delay: float = 0.0) -> None:
+        with open(os.path.join(DUMPS, dump), encoding='utf-8') as f:
+            self.xml = f.read()
+        self.delay = delay
+        # /screenshot/0 answers 404 until a test sets the image
+        self.png = None
+        self.calls = []
+
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        path = request.url.path
+        if path == '/jsonrpc/0':
+            body = json.loads(request.content)
+            if isinstance(body, list):
+                self.calls.append(('batch', [b['method'] for b in body]))
+                return httpx.Response(200, json=[self.rpc(b) for b in body])
+            self.calls.append(body['method'])
+            return httpx.Response(200, json=self.rpc(body))
+        self.calls.append(path)
+        if path == '/info':
+            return httpx.Response(200, json={'display': {'width': 1080, 'height': 2400}})
+        if path == '/version':
+            return httpx.Response(200, text='0.10.0')
+        if path.startswith('/screenshot') and self.png is not None:
+            return httpx.Response(200, content=self.png)
+        return httpx.Response(404)
+
+
+    def rpc(self, body: dict) -> dict:
+        method = body['method']
+        if method == 'dumpWindowHierarchy':
+            result = self.xml
+        elif method == 'deviceInfo':
+            result = {'displayRotation': 0, 'displayWidth': 1080, 'displayHeight': 2400}
+        else:
+            result = True
+        return {'jsonrpc': '2.0', 'id': body['id'], 'result': result}
+
+
+    def device(self, url: str = 'http://10.0.0.1:7912') -> AsyncDevice:
+        return AsyncDevice(url, transport=httpx.MockTransport(self.handler))
+
+
+
+@pytest.fixture
+def agent():
+    return FakeAgent()
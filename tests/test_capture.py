@@ -0,0 +1,48 @@
+
+import asyncio
+import io
+import pytest
+
+
+from uiautomator2Async.exception import JSONRPCError
+
+
+def _png() -> bytes:
+    Image = pytest.importorskip("PIL.Image")
+    buf = io.BytesIO()
+    Image.new('RGB', (108, 240), (200, 30, 30)).save(buf, 'png')
+    return buf.getvalue()
+
+
+def _failTakeScreenshot(agent, code):
+    def rpc(body, rpc=agent.rpc):
+        if body['method'] == 'takeScreenshot':
+            return {'jsonrpc': '2.0', 'id': body['id'], 'error': {'code': code, 'message': 'failed'}}
+        return rpc(body)
+    agent.rpc = rpc
+
+
+def test_capture_falls_back_when_take_screenshot_is_missing(agent):
+    agent.png = _png()
+    _failTakeScreenshot(agent, -32601)
+
+    async def main():
+        d = agent.device()
+        for _ in range(2):
+            cap = await d.capture(0.5)
+            assert cap.method == 'http+client'
+    asyncio.run(main())
+    assert agent.calls.count('takeScreenshot') == 1
+
+
+def test_capture_raises_agent_errors(agent):
+    _failTakeScreenshot(agent, -32001)
+
+    async def main():
+        d = agent.device()
+        for _ in range(2):
+            with pytest.raises(JSONRPCError):
+                await d.capture(0.5)
+    asyncio.run(main())
+    # still supported, the second capture asked again
+    assert agent.calls.count('takeScreenshot') == 2
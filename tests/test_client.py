@@ -0,0 +1,27 @@
+import asyncio
+import httpx
+import pytest
+
+
+from uiautomator2Async import AsyncDevice
+
+
+def test_unknown_timeout_names_the_valid_ones():
+    with pytest.raises(ValueError, match="unknown timeout 'screenshots', valid: http, jsonrpc, screenshot"):
+        AsyncDevice('http://10.0.0.1:7912', timeouts={'screenshots': 5.0})
+
+
+def test_aclose_leaves_a_passed_http_client_open(agent):
+    async def main():
+        httpClient = httpx.AsyncClient(base_url='http://10.0.0.1:7912',
+                                       transport=httpx.MockTransport(agent.handler))
+        d = AsyncDevice('http://10.0.0.1:7912', httpClient=httpClient)
+        await d.aclose()
+        assert not httpClient.is_closed
+        assert await d.agentVersion() == '0.10.0'
+        await httpClient.aclose()
+
+        d = AsyncDevice('http://10.0.0.1:7912')
+        await d.aclose()
+        assert d._AsyncClient__axClient.is_closed
+    asyncio.run(main())
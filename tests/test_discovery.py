@@ -0,0 +1,31 @@
+
+import asyncio
+import httpx
+
+
+from uiautomator2Async import discover
+from uiautomator2Async.discovery import _expandTargets
+
+
+def test_expand_targets():
+    assert list(_expandTargets("10.0.0.0/30", 7912)) == ['10.0.0.1:7912', '10.0.0.2:7912']
+    assert list(_expandTargets(["10.0.0.9", "10.0.0.9:8000", "phone.lan"], 7912)) == \
+        ['10.0.0.9:7912', '10.0.0.9:8000', 'phone.lan:7912']
+    assert list(_expandTargets(["fe80::1", "[fe80::2]", "[fe80::3]:8000"], 7912)) == \
+        ['[fe80::1]:7912', '[fe80::2]:7912', '[fe80::3]:8000']
+    assert list(_expandTargets("fd00::/126", 7912)) == ['[fd00::1]:7912', '[fd00::2]:7912', '[fd00::3]:7912']
+
+
+def test_half_open_host_is_bounded_by_timeout(agent):
+    async def handler(request):
+        if request.url.host == '10.0.0.2' and request.url.path == '/info':
+            await asyncio.sleep(5)
+        return await agent.handler(request)
+
+    async def main():
+        found = []
+        async for d in discover(["10.0.0.1", "10.0.0.2"], timeout=0.2,
+                                transport=httpx.MockTransport(handler)):
+            found.append(d._agentUrl)
+        return found
+    assert asyncio.run(asyncio.wait_for(main(), 2)) == ['http://10.0.0.1:7912']
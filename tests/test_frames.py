@@ -0,0 +1,23 @@
+
+import asyncio
+import pytest
+
+
+from uiautomator2Async.exception import JSONRPCError
+
+
+def test_every_next_raises_after_the_producer_failed(agent):
+    def rpc(body, rpc=agent.rpc):
+        if body['method'] == 'takeScreenshot':
+            return {'jsonrpc': '2.0', 'id': body['id'], 'error': {'code': -32001, 'message': 'failed'}}
+        return rpc(body)
+    agent.rpc = rpc
+
+    async def main():
+        stream = agent.device().frames(fps=20)
+        frames = stream.__aiter__()
+        for _ in range(2):
+            with pytest.raises(JSONRPCError):
+                await asyncio.wait_for(frames.__anext__(), 1)
+        await stream.aclose()
+    asyncio.run(main())
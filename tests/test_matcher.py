@@ -0,0 +1,67 @@
+
+"""
+SelectorMatcher against what UiAutomator answers on the device
+
+dumps/<name>.xml is a window hierarchy as dumpWindowHierarchy returns it,
+dumps/<name>.json its cases. A case is a selector with an optional
+child / sibling chain and the device results for it:
+
+    find: bounds of UiObject.info, null if it does not exist
+    count: UiObject.count
+    findAll: bounds of obj[0], obj[1] ... until one does not exist
+"""
+
+import json
+import os
+import pytest
+
+
+from uiautomator2Async.hierarchy import Hierarchy
+from uiautomator2Async.matcher import SelectorMatcher
+from uiautomator2Async.selector import Selector
+
+
+DUMPS = os.path.join(os.path.dirname(__file__), 'dumps')
+
+
+
+def _cases():
+    for fileName in sorted(os.listdir(DUMPS)):
+        name, ext = os.path.splitext(fileName)
+        if ext != '.json':
+            continue
+        with open(os.path.join(DUMPS, fileName), encoding='utf-8') as f:
+            for i, case in enumerate(json.load(f)):
+                yield pytest.param(name, case, id=f"{name}-{i}")
+
+
+def _matcher(name: str, cache={}) -> SelectorMatcher:
+    if name not in cache:
+        with open(os.path.join(DUMPS, name + '.xml'), 'rb') as f:
+            cache[name] = SelectorMatcher(Hierarchy(f.read()))
+    return cache[name]
+
+
+def _selector(case: dict) -> Selector:
+    sel = Selector(**case['selector'])
+    for kind, kwargs in case.get('chain', []):
+        getattr(sel, kind)(**kwargs)
+    return sel
+
+
+def _bounds(matcher: SelectorMatcher, i):
+    if i is None:
+        return None
+    return "[{},{}][{},{}]".format(*matcher.table.getBounds(i))
+
+
+
+@pytest.mark.parametrize("name, case", list(_cases()))
+def test_conformance(name, case):
+    matcher = _matcher(name)
+    sel = _selector(case)
+    assert _bounds(matcher, matcher.find(sel)) == case['find']
+    if 'count' in case:
+        assert matcher.count(sel) == case['count']
+    if 'findAll' in case:
+        assert [_bounds(matcher, i) for i in matcher.findAll(sel)] == case['findAll']
@@ -0,0 +1,30 @@
+
+import asyncio
+import time
+import httpx
+
+
+from uiautomator2Async import DevicePool, Priority
+
+
+def test_check_is_bounded_while_the_device_is_busy(agent):
+    async def main():
+        pool = DevicePool(checkTimeout=0.2, transport=httpx.MockTransport(agent.handler))
+        entry = await pool.add('10.0.0.1')
+        busy = asyncio.Event()
+
+        async def holdBackgroundSlot():
+            async with entry.device.scheduler.slot(Priority.BACKGROUND):
+                busy.set()
+                await asyncio.sleep(2)
+
+        holder = asyncio.ensure_future(holdBackgroundSlot())
+        await busy.wait()
+        startTime = time.monotonic()
+        await pool.checkAll()
+        elapsed = time.monotonic() - startTime
+        holder.cancel()
+        await pool.close()
+        assert elapsed < 1
+        assert entry.failures == 1
+    asyncio.run(main())
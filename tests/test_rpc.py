@@ -0,0 +1,20 @@
+
+import asyncio
+
+
+def test_batched_input_is_interactive_and_invalidates(agent):
+    async def main():
+        d = agent.device()
+        generation = d.inputGeneration
+        async with d.jsonrpc.batch() as b:
+            b.getText({})
+        assert d.inputGeneration == generation
+        assert d.scheduler.stats()['granted']['INTERACTIVE'] == 0
+
+        async with d.jsonrpc.batch() as b:
+            b.getText({})
+            b.click(10, 20)
+        assert d.inputGeneration == generation + 1
+        assert d.scheduler.stats()['granted']['INTERACTIVE'] == 1
+    asyncio.run(main())
+    assert agent.calls == [('batch', ['getText']), ('batch', ['getText', 'click'])]
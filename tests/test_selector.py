@@ -0,0 +1,56 @@
+
+import asyncio
+
+
+def test_view_beside_uses_one_snapshot(agent):
+    def rpc(body, rpc=agent.rpc):
+        if body['method'] == 'objInfo':
+            bounds = {'left': 210, 'top': 801, 'right': 313, 'bottom': 862}
+            return {'jsonrpc': '2.0', 'id': body['id'], 'result': {'bounds': bounds}}
+        return rpc(body)
+    agent.rpc = rpc
+
+    async def main():
+        d = agent.device()
+        d.config['local_selector'] = False
+        below = await d(text="Apps").down(resourceId="android:id/title")
+        assert below.sel['instance'] == 3
+        above = await d(text="Apps").up(resourceId="android:id/title")
+        assert above.sel['instance'] == 1
+    asyncio.run(main())
+    assert agent.calls.count('dumpWindowHierarchy') == 1
+    assert 'count' not in agent.calls
+    assert agent.calls.count('objInfo') == 2
+
+
+def _notFound(body):
+    error = {'code': -32002, 'message': 'androidx.test.uiautomator.UiObjectNotFoundException',
+             'data': {'exceptionTypeName': 'androidx.test.uiautomator.UiObjectNotFoundException'}}
+    return {'jsonrpc': '2.0', 'id': body['id'], 'error': error}
+
+
+def test_missed_selector_click_is_not_input(agent):
+    state = {'shown': False}
+
+    def rpc(body, rpc=agent.rpc):
+        method, params = body['method'], body['params']
+        if method in ('click', 'objInfo') and isinstance(params[0], dict) and not state['shown']:
+            return _notFound(body)
+        if method == 'waitForExists':
+            state['shown'] = True
+        if method == 'objInfo':
+            bounds = {'left': 210, 'top': 801, 'right': 313, 'bottom': 862}
+            return {'jsonrpc': '2.0', 'id': body['id'], 'result': {'bounds': bounds}}
+        return rpc(body)
+    agent.rpc = rpc
+
+    async def main():
+        d = agent.device()
+        d.config['local_selector'] = False
+        generation = d.inputGeneration
+        await d(text="Apps").click()
+        # one coordinate click, the missed selector click changed nothing
+        assert d.inputGeneration == generation + 1
+    asyncio.run(main())
+    assert agent.calls[0] == 'click' and agent.calls[-1] == 'click'
+    assert 'waitForExists' in agent.calls
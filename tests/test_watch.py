@@ -0,0 +1,21 @@
+
+import asyncio
+
+
+def test_stop_start_keeps_the_new_loop(agent):
+    async def main():
+        d = agent.device()
+        wc = d.watchContext(interval=0.05)
+        wc.when("Apps").call(lambda: None)
+        wc.start()
+        await asyncio.sleep(0.1)
+        wc.stop()
+        wc.start()
+        ticks = wc.ticks
+        await asyncio.sleep(0.3)
+        try :
+            assert wc.running
+            assert wc.ticks > ticks
+        finally :
+            wc.stop()
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+
+import os
+import pytest
+
+
+from uiautomator2Async.hierarchy import Hierarchy
+from uiautomator2Async.xpath import _compileXPath, _indexQuery, _matchIds
+
+
+DUMPS = os.path.join(os.path.dirname(__file__), 'dumps')
+
+
+def _hierarchy(name: str) -> Hierarchy:
+    with open(os.path.join(DUMPS, name), 'rb') as f:
+        return Hierarchy(f.read())
+
+
+@pytest.mark.parametrize("name, xpath", [
+    ('settings.xml', r'^\d+%'),
+    ('settings.xml', r'^Network\s&'),
+    ('settings.xml', '@android:id/title'),
+    ('settings.xml', 'Network & internet'),
+    ('dialog.xml', "Don't ask again"),
+    ('dialog.xml', "Don't%"),
+    ('dialog.xml', "%can't be undone.%"),
+    ('dialog.xml', "%'t ask again"),
+    ('dialog.xml', r"^Don't\s"),
+    ('dialog.xml', 'say "hi"'),
+    ('dialog.xml', 'it\'s "both"'),
+    ('dialog.xml', r'%\n%'),
+])
+def test_index_and_xpath_agree(name, xpath):
+    """ the AttributeIndex shortcut returns what the compiled xpath returns """
+    hierarchy = _hierarchy(name)
+    assert _indexQuery(xpath) is not None
+    compiled = sorted(map(hierarchy.indexOf, _compileXPath(xpath)(hierarchy.root)))
+    assert sorted(set(_matchIds(hierarchy, xpath))) == compiled
+
+
+def test_patterns_match():
+    assert list(_matchIds(_hierarchy('settings.xml'), r'^\d+%'))
+    assert list(_matchIds(_hierarchy('dialog.xml'), "Don't ask again"))
@@ -7,15 +7,39 @@ from typing import Any, List, Optional
 
 
 from .selector import Selector, UiObject
-from .client import AsyncClient
+from .client import AsyncClient, sharedTransport
+from .capture import Capture
+from .frames import Frame, FrameStream
+from .image import ImageLocator, ImageMatch
 from .swipe import SwipeExt
 from .xpath import XPath
+from .hierarchy import Hierarchy
 from .watch import AsyncWatchContext
+from .waiter import ALL, ANY, WaitEngine
+from .discovery import discover
+from .broadcast import BroadcastResult, broadcast, broadcastAll
+from .scheduler import Priority, RequestScheduler, priority
+
+
+__all__ = [
+    "AsyncDevice", "connectWifi", "DevicePool",
+    "AsyncClient", "sharedTransport", "Selector", "UiObject",
+    "XPath", "Hierarchy", "SwipeExt", "AsyncWatchContext",
+    "Capture", "Frame", "FrameStream", "ImageLocator", "ImageMatch",
+    "discover", "BroadcastResult", "broadcast", "broadcastAll",
+    "Priority", "RequestScheduler", "priority",
+]
+
 
 class AsyncDevice(AsyncClient) :
 
-    def __init__(self, agentUrl: str) :
-        super().__init__(agentUrl)
+    def __init__(self, agentUrl: str, **httpOptions: Any) :
+        """
+        Args:
+            agentUrl: like http://10.0.0.1:7912
+            httpOptions: limits, keepaliveExpiry, timeouts, transport, http2, see AsyncClient
+        """
+        super().__init__(agentUrl, **httpOptions)
 
 
 
@@ -25,26 +49,73 @@ class AsyncDevice(AsyncClient) :
         return UiObject(self, Selector(**kwds))
     
 
+    def frames(self, fps: float = 2.0, bufferSize: int = 30, **kwargs: Any) -> FrameStream:
+        """ continuous capture, see FrameStream """
+        return FrameStream(self, fps=fps, bufferSize=bufferSize, **kwargs)
+
+
     @cached_property
     def xpath(self) -> XPath:
         return XPath(self)
 
 
+    @cached_property
+    def image(self) -> ImageLocator:
+        return ImageLocator(self)
+
+
     @cached_property
     def swipeExt(self) -> SwipeExt:
         return SwipeExt(self)
+
+
+    @cached_property
+    def waiter(self) -> WaitEngine:
+        return WaitEngine(self)
+
+
+    async def waitAny(self, *conditions: Any, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        Wait until one of the conditions holds, all share one polling loop
+
+        Args:
+            conditions: UiObject, XPathSelector or xpath strings
+            timeout (float): seconds, default config['wait_timeout']
+
+        Returns:
+            index of the condition which fired, None on timeout
+
+        Example:
+            fired = await d.waitAny(d(text="Done"), '//*[@resource-id="error"]', "Login")
+        """
+        return await self.waiter.wait(conditions, ANY, timeout)
+
+
+    async def waitAll(self, *conditions: Any, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until all conditions hold at once, see waitAny
+
+        Returns:
+            False on timeout
+        """
+        return await self.waiter.wait(conditions, ALL, timeout) is not None
     
 
     def watchContext(self, autostart: bool = True,
-                     builtin: bool = False, interval: float = 2.0) -> AsyncWatchContext:
-        wc = AsyncWatchContext(self, builtin=builtin, interval=interval)
+                     builtin: bool = False, interval: float = 2.0, **kwargs: Any) -> AsyncWatchContext:
+        """
+        Args:
+            kwargs: minInterval, maxInterval, cooldown, see AsyncWatchContext
+        """
+        wc = AsyncWatchContext(self, builtin=builtin, interval=interval, **kwargs)
         if autostart:
             wc.start()
         return wc
     
 
     async def appInfo(self, pkgName: str) -> Any :
-        resp = await self.http.get(f'/app/{pkgName}/info')
+        async with self.scheduler.slot():
+            resp = await self.http.get(f'/app/{pkgName}/info')
         resp.raise_for_status()
 
         rData = resp.json()
@@ -65,7 +136,7 @@ class AsyncDevice(AsyncClient) :
             await self.appStop(pkgName, userID)
 
         if not activity:
-            info = self.appInfo(pkgName)
+            info = await self.appInfo(pkgName)
             activity = info['mainActivity']
             if activity.find(".") == -1:
                 activity = "." + activity
@@ -77,6 +148,7 @@ class AsyncDevice(AsyncClient) :
             '--user', userID,
         ]
         await self.shell(args)
+        self.invalidateHierarchy()
 
     
     async def userIDs(self) -> List[str] :
@@ -91,26 +163,36 @@ class AsyncDevice(AsyncClient) :
         return SwipeExt(self)
 
 
-async def _fixWifiAddr(addr: str) -> Optional[str] :
+def _fixWifiAddr(addr: str) -> str :
     if ':' not in addr :
         addr += ':7912'
+    return "http://" + addr
 
-    async with httpx.AsyncClient() as client:
-        try :
-            resp = await client.get(f'http://{addr}/version', timeout=2)
-            resp.raise_for_status()
-            return "http://" + addr
-        except httpx.HTTPStatusError:
-            return None
 
 
 
+async def connectWifi(addr: str, **httpOptions: Any) -> Optional[AsyncDevice] :
+    """
+    Args:
+        addr: ip or ip:port of atx-agent
+        httpOptions: see AsyncDevice
 
-async def connectWifi(addr: str) -> Optional[AsyncDevice] :
-    addr = await _fixWifiAddr(addr)
-    if addr is None :
+    Returns:
+        AsyncDevice or None if addr is not an atx-agent, the probe
+        connection is kept by the device
+    """
+    device = AsyncDevice(_fixWifiAddr(addr), **httpOptions)
+    try :
+        await device.agentVersion(timeout=2)
+    except httpx.HTTPError:
+        await device.aclose()
         return None
-    else :
-        return AsyncDevice(addr)
-    
+    except BaseException:
+        await device.aclose()
+        raise
+    return device
+
+
+
 
+from .pool import DevicePool
@@ -0,0 +1,86 @@
+
+import asyncio
+from dataclasses import dataclass
+import functools
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Union
+
+
+from .client import AsyncClient
+
+
+
+@dataclass
+class BroadcastResult :
+    device: AsyncClient
+    result: Any = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+
+async def broadcast(devices: Iterable[AsyncClient],
+                    fn: Union[str, Callable[..., Awaitable[Any]]], *args: Any,
+                    concurrency: int = 16, timeout: Optional[float] = None,
+                    **kwargs: Any) -> AsyncIterator[BroadcastResult]:
+    """
+    Run one operation on many devices, results are yielded as they complete
+
+    Args:
+        devices: AsyncDevice list
+        fn: name of a device coroutine method like "shell", or a coroutine
+            function called as fn(device, *args, **kwargs)
+        concurrency (int): max devices running at the same time
+        timeout (float): per device timeout in seconds, an expired device
+            gets asyncio.TimeoutError as error
+
+    Yields:
+        BroadcastResult, failures are reported with error set
+
+    Example:
+        async for r in broadcast(devices, "shell", "getprop ro.serialno"):
+            print(r.device, r.result if r.ok else r.error)
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _run(device: AsyncClient) -> BroadcastResult:
+        async with semaphore:
+            startTime = time.monotonic()
+            try :
+                if isinstance(fn, str):
+                    call = getattr(device, fn)
+                else:
+                    call = functools.partial(fn, device)
+                result = await asyncio.wait_for(call(*args, **kwargs), timeout)
+                return BroadcastResult(device, result, None, time.monotonic() - startTime)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return BroadcastResult(device, None, e, time.monotonic() - startTime)
+
+    tasks = [asyncio.ensure_future(_run(device)) for device in devices]
+    try :
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally :
+        for task in tasks:
+            task.cancel()
+
+
+
+async def broadcastAll(devices: Iterable[AsyncClient],
+                       fn: Union[str, Callable[..., Awaitable[Any]]], *args: Any,
+                       concurrency: int = 16, timeout: Optional[float] = None,
+                       **kwargs: Any) -> List[BroadcastResult]:
+    """
+    Like broadcast but waits for every device
+
+    Returns:
+        BroadcastResult list in completion order
+    """
+    return [r async for r in broadcast(devices, fn, *args, concurrency=concurrency,
+                                       timeout=timeout, **kwargs)]
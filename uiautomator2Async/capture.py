@@ -0,0 +1,87 @@
+
+from dataclasses import dataclass
+import hashlib
+import io
+from typing import Optional, Tuple
+
+try :
+    from PIL import Image
+except ImportError :
+    Image = None
+
+
+
+@dataclass
+class Capture :
+    """ one screenshot with what it cost """
+    data: bytes
+    format: str
+    # how it was taken: "http" /screenshot/0, "jsonrpc" takeScreenshot, "+client" processed here
+    method: str
+    # bytes received from the agent
+    wireBytes: int
+    # seconds spent on the agent round trip
+    elapsed: float
+    # seconds spent decoding / scaling / encoding on the client
+    clientTime: float = 0.0
+    size: Optional[Tuple[int, int]] = None
+
+
+
+def _requirePIL():
+    if Image is None:
+        raise RuntimeError("client side scale/crop/format needs Pillow, pip install pillow")
+
+
+def processImage(data: bytes, scale: float = 1.0, quality: Optional[int] = None,
+                 format: Optional[str] = None, crop: Optional[tuple] = None) -> Tuple[bytes, str, Tuple[int, int]]:
+    """
+    Crop, downscale and re-encode an image
+
+    Args:
+        scale (float): 0 < scale <= 1
+        quality (int): jpeg quality
+        format (str): "png" or "jpeg", default keeps the source format
+        crop: (left, top, right, bottom) in pixels of data
+
+    Returns:
+        (bytes, format, (width, height))
+    """
+    _requirePIL()
+    image = Image.open(io.BytesIO(data))
+    format = (format or image.format or 'png').lower()
+    if crop is not None:
+        image = image.crop(tuple(crop))
+    if scale != 1.0:
+        width, height = image.size
+        image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.BILINEAR)
+
+    out = io.BytesIO()
+    if format in ('jpeg', 'jpg'):
+        format = 'jpeg'
+        image.convert('RGB').save(out, 'JPEG', quality=quality or 80)
+    else:
+        image.save(out, format.upper())
+    return out.getvalue(), format, image.size
+
+
+def perceptualHash(data: bytes) -> int:
+    """
+    64 bit difference hash of an image, similar images have a small hamming
+    distance. Without Pillow this degrades to a hash of the bytes
+    """
+    if Image is None:
+        return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (64, 64))
+    pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def hammingDistance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
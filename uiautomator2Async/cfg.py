@@ -14,6 +14,27 @@ class Config(object) :
 
         self._defaults = {
             "wait_timeout": 20.0,
+            "hierarchy_cache_ttl": 1.0,
+            # evaluate UiObject queries against the local hierarchy snapshot
+            "local_selector": False,
+            "local_poll_interval": 0.5,
+            # max age of the cached display rotation, see AsyncClient.windowSize
+            "window_size_ttl": 60.0,
+            # max concurrent JSON-RPC requests per device
+            "jsonrpc_max_inflight": 8,
+            # request scheduler, see RequestScheduler
+            "scheduler_interactive_reserve": 1,
+            "scheduler_background_slots": 1,
+            "scheduler_aging": 2.0,
+            # http timeouts in seconds per endpoint
+            "http_timeout": 10.0,
+            "jsonrpc_timeout": 60.0,
+            "screenshot_timeout": 10.0,
+            # chunks buffered between the screenshot download and its sink
+            "screenshot_queue_size": 8,
+            # waitIdle: seconds without change which count as settled, and its timeout
+            "idle_quiet": 0.5,
+            "idle_timeout": 10.0,
             "reset_adb_wifi_addr": None,
             "reset_atx_listen_addr": None
         }
@@ -1,19 +1,33 @@
 
 
 import asyncio
+import base64
 from dataclasses import dataclass
+import logging
+import functools
 from functools import cached_property
+import inspect
+import os
 import re
-from typing import Any, List, Optional, Tuple, Union
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 import httpx
 from tenacity import RetryError
 import xml.dom.minidom
 
 
+from .capture import Capture, perceptualHash, processImage
 from .cfg import Config
+from .exception import JSONRPCError, StaleRequestError
+from .hierarchy import Hierarchy
 from .rpc import JSONRpcWrapper
+from .scheduler import Priority, RequestScheduler, currentPriority
 from .utils import list2cmdline
 
+
+logger = logging.getLogger(__name__)
+
+
 @dataclass
 class ShellResponse :
     exitCode: int
@@ -26,24 +40,128 @@ ACTION_UP = 1
 
 SCROLL_STEPS = 55
 
+# shell commands which produce input events, see AsyncClient.shell
+_INPUT_SHELL_RE = re.compile(r'(^|[\s;&|\'"])input\s')
+
+_HIERARCHY_ROTATION_RE = re.compile(r'<hierarchy[^>]* rotation="(\d)"')
+
+# agents sit idle between test steps, keep their connections warm
+DEFAULT_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=60.0)
+
+# endpoints of AsyncClient(timeouts=...), each maps to the config key <name>_timeout
+TIMEOUT_NAMES = ('http', 'jsonrpc', 'screenshot')
+
+
+
+def sharedTransport(limits: Optional[httpx.Limits] = None, http2: bool = False,
+                    retries: int = 0) -> httpx.AsyncHTTPTransport:
+    """
+    Connection pool which many devices can share, see AsyncClient(transport=...)
+
+    Args:
+        limits: pool limits of all devices together
+        http2 (bool): requires the h2 package
+        retries (int): connect retries
+    """
+    return httpx.AsyncHTTPTransport(limits=limits or DEFAULT_LIMITS, http2=http2, retries=retries)
+
 
 
 class AsyncClient(object) :
 
 
-    def __init__(self, agentUrl: str) -> None:
+    def __init__(self, agentUrl: str,
+                 limits: Optional[httpx.Limits] = None,
+                 keepaliveExpiry: Optional[float] = None,
+                 timeouts: Optional[Dict[str, float]] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 http2: bool = False,
+                 httpClient: Optional[httpx.AsyncClient] = None) -> None:
+        """
+        Args:
+            agentUrl: like http://10.0.0.1:7912
+            limits: connection pool limits, default DEFAULT_LIMITS
+            keepaliveExpiry: seconds an idle connection is kept, overrides limits
+            timeouts: per endpoint timeouts {"http": .., "jsonrpc": .., "screenshot": ..}
+            transport: shared transport, see sharedTransport(), limits and http2 are ignored then
+            http2 (bool): requires the h2 package
+            httpClient: use this client, e.g. the one which probed the agent
+        """
         self._agentUrl = agentUrl
-        self.__axClient = httpx.AsyncClient(base_url=self._agentUrl)
+        # filled by agentVersion() and deviceInfo()
+        self.version: Optional[str] = None
+        self.lastDeviceInfo: Optional[dict] = None
+        for name, value in (timeouts or {}).items():
+            if name not in TIMEOUT_NAMES:
+                raise ValueError("unknown timeout %r, valid: %s" % (name, ', '.join(TIMEOUT_NAMES)))
+            self.config[f'{name}_timeout'] = value
+
+        # a passed httpClient or transport belongs to the caller
+        self.__ownsClient = transport is None and httpClient is None
+        if httpClient is not None:
+            self.__axClient = httpClient
+        else:
+            limits = limits or DEFAULT_LIMITS
+            if keepaliveExpiry is not None:
+                limits = httpx.Limits(max_connections=limits.max_connections,
+                                      max_keepalive_connections=limits.max_keepalive_connections,
+                                      keepalive_expiry=keepaliveExpiry)
+            kwargs = dict(transport=transport) if transport is not None else dict(limits=limits, http2=http2)
+            self.__axClient = httpx.AsyncClient(base_url=self._agentUrl,
+                                                timeout=self.config['http_timeout'], **kwargs)
+
+        # hierarchy snapshot cache, see dumpHierarchy
+        self.__hierarchyGen = 0
+        self.__hierarchyCache = {}
+        self.__hierarchyTasks = {}
+        self.__inputWaiters = set()
+        self.__hierarchy = None
+
+        # display geometry cache, see windowSize
+        self.__displaySize = None
+        self.__rotation = None
+
+        # None: unknown, False: the agent has no takeScreenshot jsonrpc
+        self.__takeScreenshotSupported = None
+
+
+    async def aclose(self):
+        """ close the http client, a passed httpClient or shared transport is left open """
+        if self.__ownsClient:
+            await self.__axClient.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.aclose()
 
 
     @property
     async def info(self) -> Any :
-        return self.jsonrpc.deviceInfo()
+        return await self.jsonrpc.deviceInfo()
 
 
     async def deviceInfo(self) -> dict:
-        resp = await self.__axClient.get('/info')
-        return resp.json()
+        async with self.scheduler.slot():
+            resp = await self.__axClient.get('/info')
+        self.lastDeviceInfo = resp.json()
+        return self.lastDeviceInfo
+
+
+    async def agentVersion(self, timeout: Optional[float] = None) -> str:
+        """
+        Returns:
+            atx-agent version, also kept in self.version
+
+        Raises:
+            httpx.HTTPError
+        """
+        async with self.scheduler.slot():
+            resp = await self.__axClient.get('/version', timeout=timeout or self.config['http_timeout'])
+        resp.raise_for_status()
+        self.version = resp.text.strip()
+        return self.version
     
 
     @cached_property
@@ -55,9 +173,19 @@ class AsyncClient(object) :
     def http(self) -> httpx.AsyncClient:
         return self.__axClient
 
-    @property
-    def jsonrpc(self) :
-        return JSONRpcWrapper(self.__axClient)
+    @cached_property
+    def scheduler(self) -> RequestScheduler:
+        """ request slots of this device, every agent call goes through it """
+        return RequestScheduler(self.config['jsonrpc_max_inflight'],
+                                self.config['scheduler_interactive_reserve'],
+                                self.config['scheduler_background_slots'],
+                                self.config['scheduler_aging'])
+
+    @cached_property
+    def jsonrpc(self) -> JSONRpcWrapper:
+        return JSONRpcWrapper(self.__axClient, self.config['jsonrpc_max_inflight'],
+                              self.config['jsonrpc_timeout'], self.scheduler,
+                              onInput=self.invalidateHierarchy)
     
 
     async def shell(self, cmdargs: Union[str, List[str]], timeout=60) -> Any :
@@ -69,9 +197,14 @@ class AsyncClient(object) :
             raise TypeError("cmdargs type invalid", type(cmdargs))
         
         data = dict(command=cmdline, timeout=str(timeout))
-        resp = await self.__axClient.post('/shell', data=data, timeout=httpx.Timeout(timeout))
+        isInput = _INPUT_SHELL_RE.search(cmdline) is not None
+        async with self.scheduler.slot(default=Priority.INTERACTIVE if isInput else Priority.QUERY):
+            resp = await self.__axClient.post('/shell', data=data, timeout=httpx.Timeout(timeout))
         resp.raise_for_status()
 
+        if isInput:
+            self.invalidateHierarchy()
+
         rData = resp.json()
         exitCode = 1 if rData.get('error') else 0
         exitCode = rData.get('exitCode', exitCode)
@@ -79,40 +212,306 @@ class AsyncClient(object) :
     
 
 
-    async def dumpHierarchy(self, compressed=False, pretty=False) -> str:
+    def invalidateHierarchy(self):
+        """
+        Drop cached hierarchy snapshots
+
+        Called after every input-producing call, dumps which are still in flight
+        will not be stored into the cache
+        """
+        self.__hierarchyGen += 1
+        self.__hierarchyCache.clear()
+        self.scheduler.cancelStale()
+        for waiter in self.__inputWaiters:
+            if not waiter.done():
+                waiter.set_result(self.__hierarchyGen)
+        self.__inputWaiters.clear()
+
+
+    @property
+    def inputGeneration(self) -> int:
+        """ counter bumped by every input-producing call, see invalidateHierarchy """
+        return self.__hierarchyGen
+
+
+    async def waitInput(self, timeout: float) -> bool:
+        """
+        Wait for the next input-producing call
+
+        Returns:
+            True if one happened within timeout
+        """
+        waiter = asyncio.get_event_loop().create_future()
+        self.__inputWaiters.add(waiter)
+        try :
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError :
+            return False
+        finally :
+            self.__inputWaiters.discard(waiter)
+
+
+    async def dumpHierarchy(self, compressed=False, pretty=False, maxAge: Optional[float] = None) -> str:
+        """
+        Args:
+            compressed (bool): dump compressed hierarchy
+            pretty (bool): format xml
+            maxAge (float): max age in seconds of a cached snapshot,
+                default config['hierarchy_cache_ttl'], 0 means always dump
+
+        Returns:
+            xml content
+        """
+        if maxAge is None:
+            maxAge = self.config['hierarchy_cache_ttl']
+
+        cached = self.__hierarchyCache.get(compressed)
+        if cached and time.monotonic() - cached[0] <= maxAge:
+            content = cached[1]
+        else:
+            content = await self.__sharedDump(compressed)
+
+        if pretty and "\n " not in content:
+            xml_text = xml.dom.minidom.parseString(content.encode("utf-8"))
+            content = xml_text.toprettyxml(indent='  ')
+        return content
+
+
+    async def hierarchy(self, maxAge: Optional[float] = None) -> Hierarchy:
+        """
+        Returns:
+            parsed Hierarchy of the current snapshot, parsed once per dump
+        """
+        content = await self.dumpHierarchy(maxAge=maxAge)
+        hierarchy = self.__hierarchy
+        if hierarchy is None or hierarchy.source != content:
+            hierarchy = Hierarchy(content)
+            self.__hierarchy = hierarchy
+        return hierarchy
+
+
+    async def __sharedDump(self, compressed: bool) -> str:
+        # concurrent callers share one in-flight dump of the same generation,
+        # never one started at a lower priority which could queue behind the caller
+        level = currentPriority()
+        while True:
+            gen = self.__hierarchyGen
+            task = None
+            for p in Priority:
+                if p <= level and (compressed, gen, p) in self.__hierarchyTasks:
+                    task = self.__hierarchyTasks[(compressed, gen, p)]
+                    break
+            if task is None:
+                key = (compressed, gen, level)
+                task = asyncio.ensure_future(self.__dump(compressed, gen))
+                self.__hierarchyTasks[key] = task
+                task.add_done_callback(lambda _, key=key: self.__hierarchyTasks.pop(key, None))
+            try :
+                return await asyncio.shield(task)
+            except StaleRequestError :
+                # a background dump was dropped after input, others dump the new screen
+                if level == Priority.BACKGROUND:
+                    raise
+
+
+    async def __dump(self, compressed: bool, gen: int) -> str:
+        startTime = time.monotonic()
         content = await self.jsonrpc.dumpWindowHierarchy(compressed, None)
         if content == "":
             raise RetryError("dump hierarchy is empty")
 
-        if pretty and "\n " not in content:
-            xml_text = xml.dom.minidom.parseString(content.encode("utf-8"))
-            content = xml_text.decode('utf-8').toprettyxml(indent='  ')
+        if gen == self.__hierarchyGen:
+            self.__hierarchyCache[compressed] = (startTime, content)
         return content
 
 
 
-    async def screenshot(self, fileName: Optional[str] = None):
-        if fileName is None :
-            resp = await self.__axClient.get('/screenshot/0', timeout=httpx.Timeout(10))
+    async def screenshot(self, fileName: Optional[str] = None, sink: Any = None):
+        """
+        Args:
+            fileName: stream the image into this file, written off the event loop
+            sink: stream the image into an object with a write(bytes) method,
+                a coroutine write is awaited, a plain one runs in the executor
+
+        Returns:
+            image bytes, or the number of bytes streamed into fileName / sink
+        """
+        if fileName is None and sink is None :
+            async with self.scheduler.slot():
+                resp = await self.__axClient.get('/screenshot/0', timeout=httpx.Timeout(self.config['screenshot_timeout']))
+            resp.raise_for_status()
             return resp.content
-        else :
-            async with self.__axClient.stream('GET', '/screenshot/0') as resp:
-                fileOut = open(fileName, 'wb')
-                async for chunk in resp.aiter_bytes():
-                    fileOut.write(chunk)
-                fileOut.close()
+
+        if sink is not None :
+            return await self._streamTo('/screenshot/0', self.__sinkWriter(sink))
+
+        loop = asyncio.get_event_loop()
+        fileOut = await loop.run_in_executor(None, open, fileName, 'wb')
+        try :
+            written = await self._streamTo('/screenshot/0', functools.partial(loop.run_in_executor, None, fileOut.write))
+        except BaseException :
+            await loop.run_in_executor(None, fileOut.close)
+            await loop.run_in_executor(None, os.remove, fileName)
+            raise
+        await loop.run_in_executor(None, fileOut.close)
+        return written
+
+
+    async def capture(self, scale: float = 1.0, quality: Optional[int] = None,
+                      format: Optional[str] = None, crop: Optional[tuple] = None) -> Capture:
+        """
+        Screenshot with scale / quality / format / crop
+
+        Scaled or jpeg captures use the takeScreenshot jsonrpc, which downscales
+        and compresses on the device. Crop, png conversion and agents without
+        takeScreenshot fall back to client side processing (needs Pillow)
+
+        Args:
+            scale (float): 0 < scale <= 1
+            quality (int): jpeg quality 1-100
+            format (str): "png" or "jpeg"
+            crop: (left, top, right, bottom) in device pixels
+
+        Returns:
+            Capture with data, wireBytes and elapsed
+        """
+        assert 0 < scale <= 1, "scale should be in (0, 1]"
+        format = format.lower() if format else None
+        if format == 'jpg':
+            format = 'jpeg'
+
+        startTime = time.monotonic()
+        if (scale != 1.0 or quality is not None or format == 'jpeg') and format != 'png' \
+                and self.__takeScreenshotSupported is not False:
+            try :
+                encoded = await self.jsonrpc.takeScreenshot(scale, quality or 80)
+                self.__takeScreenshotSupported = True
+            except JSONRPCError as e :
+                if e.code not in (-32601, -32602):
+                    raise
+                logger.debug("takeScreenshot not available: %s", e)
+                self.__takeScreenshotSupported = False
+            else :
+                cap = Capture(base64.b64decode(encoded), 'jpeg', 'jsonrpc',
+                              len(encoded), time.monotonic() - startTime)
+                if crop is not None:
+                    cropped = tuple(int(v * scale) for v in crop)
+                    cap = await self.__process(cap, 1.0, quality, 'jpeg', cropped)
+                return self.__report(cap)
+
+        data = await self.screenshot()
+        cap = Capture(data, 'png', 'http', len(data), time.monotonic() - startTime)
+        format = format or ('jpeg' if quality is not None else 'png')
+        if scale != 1.0 or crop is not None or format != 'png':
+            cap = await self.__process(cap, scale, quality, format, crop)
+        return self.__report(cap)
+
+
+    @staticmethod
+    async def __process(cap: Capture, scale, quality, format, crop) -> Capture:
+        """ decode, resize and encode in the executor, off the event loop """
+        startTime = time.monotonic()
+        loop = asyncio.get_event_loop()
+        data, format, size = await loop.run_in_executor(None, processImage, cap.data, scale, quality, format, crop)
+        return Capture(data, format, cap.method + '+client', cap.wireBytes, cap.elapsed,
+                       time.monotonic() - startTime, size)
+
+
+    @staticmethod
+    def __report(cap: Capture) -> Capture:
+        logger.debug("capture %s %s: %d bytes on wire, %.3fs, %.3fs on client",
+                     cap.method, cap.format, cap.wireBytes, cap.elapsed, cap.clientTime)
+        return cap
+
+
+    @staticmethod
+    def __sinkWriter(sink: Any):
+        write = getattr(sink, 'write', sink)
+        if inspect.iscoroutinefunction(write):
+            return write
+        return functools.partial(asyncio.get_event_loop().run_in_executor, None, write)
+
+
+    async def _streamTo(self, path: str, write) -> int:
+        """
+        Stream GET path into the coroutine write(chunk), through a queue of
+        config['screenshot_queue_size'] chunks so a slow sink pauses the download
+
+        Returns:
+            number of bytes written
+        """
+        queue = asyncio.Queue(maxsize=self.config['screenshot_queue_size'])
+
+        async def writer():
+            written = 0
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    return written
+                await write(chunk)
+                written += len(chunk)
+
+        writerTask = asyncio.ensure_future(writer())
+        try :
+            timeout = httpx.Timeout(self.config['screenshot_timeout'])
+            async with self.scheduler.slot():
+                async with self.__axClient.stream('GET', path, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    async for chunk in resp.aiter_bytes():
+                        putTask = asyncio.ensure_future(queue.put(chunk))
+                        await asyncio.wait([putTask, writerTask], return_when=asyncio.FIRST_COMPLETED)
+                        if writerTask.done():
+                            putTask.cancel()
+                            # the sink failed, raise its error
+                            return writerTask.result()
+            await queue.put(None)
+            return await writerTask
+        finally :
+            writerTask.cancel()
+
+
+    def invalidateWindowSize(self):
+        """ forget the cached display geometry """
+        self.__displaySize = None
+        self.__rotation = None
 
 
     #return  (width, height)
     async def windowSize(self):
-        info = await self.http.get('/info').json()
-        w, h = info['display']['width'], info['display']['height']
-        rotation = await self._getOrientation()
+        """
+        Display size is cached, rotation is refreshed every config['window_size_ttl']
+        seconds or when a newer hierarchy snapshot reports another rotation
+        """
+        if self.__displaySize is None:
+            async with self.scheduler.slot():
+                info = (await self.http.get('/info')).json()
+            self.__displaySize = info['display']['width'], info['display']['height']
+
+        w, h = self.__displaySize
+        rotation = await self.__currentRotation()
         if (w > h) != (rotation % 2 == 1):
             w, h = h, w
         return w, h
 
 
+    async def __currentRotation(self) -> int:
+        now = time.monotonic()
+        cached = self.__rotation
+
+        # rotation probe: the hierarchy root carries the rotation for free
+        for startTime, content in self.__hierarchyCache.values():
+            if cached is not None and startTime <= cached[1]:
+                continue
+            m = _HIERARCHY_ROTATION_RE.search(content, 0, 512)
+            if m:
+                cached = self.__rotation = (int(m.group(1)), startTime)
+
+        if cached is None or now - cached[1] > self.config['window_size_ttl']:
+            cached = self.__rotation = (await self._getOrientation(), now)
+        return cached[0]
+
+
     async def _getOrientation(self):
         """
         Rotaion of the phone
@@ -131,45 +530,114 @@ class AsyncClient(object) :
                 continue
 
             return int(m.group('orientation'))
-        return await self.info["displayRotation"]
+        return (await self.info)["displayRotation"]
     
 
 
-    async def click(self, x: Union[float, int], y: Union[float, int]):
+    async def waitIdle(self, quiet: Optional[float] = None, timeout: Optional[float] = None,
+                       screenshot: bool = False) -> bool:
+        """
+        Wait until the UI settles: the hierarchy fingerprint, and optionally a
+        perceptual hash of a small screenshot, stays the same for `quiet` seconds
+
+        Polls fast while the UI changes and slower while it is stable
+
+        Args:
+            quiet (float): default config['idle_quiet']
+            timeout (float): default config['idle_timeout']
+            screenshot (bool): also compare screenshots, for animations the hierarchy does not show
+
+        Returns:
+            False if the UI did not settle within timeout
+        """
+        quiet = self.config['idle_quiet'] if quiet is None else quiet
+        timeout = self.config['idle_timeout'] if timeout is None else timeout
+        minInterval = quiet / 8
+        deadline = time.monotonic() + timeout
+
+        interval = minInterval
+        lastState, stableSince = None, None
+        while True:
+            state = (await self.hierarchy(maxAge=0)).fingerprint
+            if screenshot:
+                data = (await self.capture(0.25, 50)).data
+                state = (state, await asyncio.get_event_loop().run_in_executor(None, perceptualHash, data))
+
+            now = time.monotonic()
+            if state != lastState:
+                lastState, stableSince = state, now
+                interval = minInterval
+            elif now - stableSince >= quiet:
+                return True
+            else:
+                interval = min(interval * 2, quiet / 2)
+
+            if now >= deadline:
+                return False
+            await asyncio.sleep(min(interval, deadline - now, max(0, stableSince + quiet - now)))
+
+
+    async def __settle(self, settle: bool):
+        if settle:
+            await self.waitIdle()
+
+
+    async def click(self, x: Union[float, int], y: Union[float, int], settle: bool = False):
+        """
+        Args:
+            settle (bool): return after the UI became idle, see waitIdle
+        """
         x, y = await self._posRel2Abs(x, y)
-        return self.jsonrpc.click(x, y)
+        try :
+            ret = await self.jsonrpc.click(x, y)
+        finally :
+            self.invalidateHierarchy()
+        await self.__settle(settle)
+        return ret
     
 
-    async def doubleClick(self, x: Union[float, int], y: Union[float, int], duration=0.1):
+    async def doubleClick(self, x: Union[float, int], y: Union[float, int], duration=0.1, settle: bool = False):
         await self.down(x, y)
         await self.up(x, y)
         await asyncio.sleep(duration)
-        return self.click(x, y)
+        return await self.click(x, y, settle=settle)
 
 
-    async def longClick(self, x: Union[float, int], y: Union[float, int], duration: float = 0.5):
+    async def longClick(self, x: Union[float, int], y: Union[float, int], duration: float = 0.5,
+                        settle: bool = False):
         await self.down(x, y)
         await asyncio.sleep(duration)
         await self.up(x, y)
+        await self.__settle(settle)
     
 
     async def down(self, x: Union[float, int], y: Union[float, int]) :
         x, y = await self._posRel2Abs(x, y)
-        return self.jsonrpc.injectInputEvent(ACTION_DOWN, x, y, 0)
+        try :
+            return await self.jsonrpc.injectInputEvent(ACTION_DOWN, x, y, 0)
+        finally :
+            self.invalidateHierarchy()
     
 
     async def move(self, x: Union[float, int], y: Union[float, int]) :
         x, y = await self._posRel2Abs(x, y)
-        return self.jsonrpc.injectInputEvent(ACTION_MOVE, x, y, 0)
+        try :
+            return await self.jsonrpc.injectInputEvent(ACTION_MOVE, x, y, 0)
+        finally :
+            self.invalidateHierarchy()
 
 
     async def up(self, x: Union[float, int], y: Union[float, int]) :
         x, y = await self._posRel2Abs(x, y)
-        return self.jsonrpc.injectInputEvent(ACTION_UP, x, y, 0)
+        try :
+            return await self.jsonrpc.injectInputEvent(ACTION_UP, x, y, 0)
+        finally :
+            self.invalidateHierarchy()
 
 
 
-    async def swipe(self, fx, fy, tx, ty, duration: Optional[float] = None, steps: Optional[int] = None):
+    async def swipe(self, fx, fy, tx, ty, duration: Optional[float] = None, steps: Optional[int] = None,
+                    settle: bool = False):
         fx, fy = await self._posRel2Abs(fx, fy)
         tx, ty = await self._posRel2Abs(tx, ty)
         if not duration:
@@ -177,7 +645,12 @@ class AsyncClient(object) :
         if not steps:
             steps = int(duration * 200)
         steps = max(2, steps)  # step=1 has no swipe effect
-        return self.jsonrpc.swipe(fx, fy, tx, ty, steps)
+        try :
+            ret = await self.jsonrpc.swipe(fx, fy, tx, ty, steps)
+        finally :
+            self.invalidateHierarchy()
+        await self.__settle(settle)
+        return ret
     
 
 
@@ -0,0 +1,144 @@
+
+import asyncio
+import ipaddress
+import logging
+from typing import Any, AsyncIterator, Iterable, Iterator, Optional, Union
+import httpx
+
+
+from .client import sharedTransport
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PORT = 7912
+
+
+
+def _hostPort(host: str, port: int) -> str:
+    """ host:port, IPv6 literals as [addr]:port """
+    if host.startswith('['):
+        return host if ']:' in host else f'{host}:{port}'
+    try :
+        address = ipaddress.ip_address(host)
+    except ValueError :
+        # a name or host:port
+        return host if ':' in host else f'{host}:{port}'
+    if address.version == 6:
+        return f'[{address}]:{port}'
+    return f'{address}:{port}'
+
+
+def _expandTargets(targets: Union[str, Iterable[str]], port: int) -> Iterator[str]:
+    """ yield host:port of every host in the CIDR ranges / host list """
+    if isinstance(targets, str):
+        targets = [targets]
+
+    for target in targets:
+        if '/' in target:
+            network = ipaddress.ip_network(target, strict=False)
+            hosts = network.hosts() if network.num_addresses > 1 else [network.network_address]
+            for host in hosts:
+                yield _hostPort(str(host), port)
+        else:
+            yield _hostPort(target, port)
+
+
+async def _probe(addr: str, timeout: float, httpOptions: dict) -> Optional[Any]:
+    from . import AsyncDevice
+
+    device = AsyncDevice('http://' + addr, **httpOptions)
+    try :
+        await device.agentVersion(timeout=timeout)
+        await asyncio.wait_for(device.deviceInfo(), timeout)
+    except (httpx.HTTPError, ValueError, asyncio.TimeoutError):
+        await device.aclose()
+        return None
+    except BaseException:
+        await device.aclose()
+        raise
+
+    logger.debug("found atx-agent %s at %s", device.version, addr)
+    return device
+
+
+async def _detach(device: Any, httpOptions: dict) -> Any:
+    """ the device on its own connections, the scan transport is closed after the scan """
+    from . import AsyncDevice
+
+    detached = AsyncDevice(device._agentUrl, **httpOptions)
+    detached.version = device.version
+    detached.lastDeviceInfo = device.lastDeviceInfo
+    await device.aclose()
+    return detached
+
+
+
+async def discover(targets: Union[str, Iterable[str]], port: int = DEFAULT_PORT,
+                   concurrency: int = 64, timeout: float = 2.0,
+                   **httpOptions: Any) -> AsyncIterator[Any]:
+    """
+    Probe hosts for atx-agent concurrently
+
+    Args:
+        targets: CIDR like "192.168.1.0/24", a host, host:port, or a list of them
+        port (int): agent port of targets without one
+        concurrency (int): max parallel probes
+        timeout (float): probe timeout in seconds
+        httpOptions: see AsyncDevice, without a transport all probes share one
+            which is closed after the scan
+
+    Yields:
+        AsyncDevice as agents respond, with version and lastDeviceInfo filled
+
+    Example:
+        async for d in discover("192.168.1.0/24"):
+            print(d.version, d.lastDeviceInfo['serial'])
+    """
+    addrs = _expandTargets(targets, port)
+    found = asyncio.Queue()
+    concurrency = max(1, concurrency)
+
+    ownsTransport = 'transport' not in httpOptions
+    probeOptions = dict(httpOptions)
+    if ownsTransport:
+        # probes go to different hosts, keeping their connections is no use
+        probeOptions['transport'] = sharedTransport(httpx.Limits(max_connections=concurrency,
+                                                                 max_keepalive_connections=0),
+                                                    http2=httpOptions.get('http2', False))
+
+    async def worker():
+        # workers share one iterator, so hosts are expanded lazily
+        for addr in addrs:
+            device = await _probe(addr, timeout, probeOptions)
+            if device is not None:
+                if ownsTransport:
+                    device = await _detach(device, httpOptions)
+                found.put_nowait(device)
+
+    async def finish():
+        try :
+            await asyncio.gather(*workers)
+        finally :
+            found.put_nowait(None)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    finisher = asyncio.ensure_future(finish())
+    try :
+        while True:
+            device = await found.get()
+            if device is None:
+                break
+            yield device
+        await finisher
+    finally :
+        for task in workers + [finisher]:
+            task.cancel()
+        await asyncio.gather(*workers, finisher, return_exceptions=True)
+        while not found.empty():
+            device = found.get_nowait()
+            if device is not None:
+                await device.aclose()
+        if ownsTransport:
+            await probeOptions['transport'].aclose()
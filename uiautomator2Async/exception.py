@@ -49,4 +49,10 @@ class JSONRPCError(BaseError):
 
 
 class UiObjectNotFoundError(JSONRPCError):
-    """ 控件没找到 """
\ No newline at end of file
+    """ 控件没找到 """
+
+class LeaseTimeout(BaseError) :
+    """ no device of the pool became available in time """
+
+class StaleRequestError(BaseError) :
+    """ a queued background request was dropped, see RequestScheduler.cancelStale """
@@ -0,0 +1,154 @@
+
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import logging
+import time
+from typing import List, Optional
+
+
+from .capture import hammingDistance, perceptualHash
+from .client import AsyncClient
+from .exception import StaleRequestError
+from .scheduler import Priority, priority
+
+
+logger = logging.getLogger(__name__)
+
+
+
+@dataclass
+class Frame :
+    seq: int
+    timestamp: float
+    data: bytes
+    format: str
+    # perceptual hash, see capture.perceptualHash
+    hash: int
+    # differs from the previous captured frame by more than the threshold
+    changed: bool
+
+
+
+class FrameStream(object) :
+    """
+    Continuous capture at a target rate
+
+    One capture is in flight at a time. When the consumer is slower than the
+    capture rate only the newest frame is delivered, skipped frames are still
+    kept in the ring buffer:
+
+        stream = d.frames(fps=4, scale=0.3)
+        async for frame in stream:
+            if frame.changed:
+                show(frame.data)
+        ...
+        await stream.aclose()
+    """
+
+    def __init__(self, client: AsyncClient, fps: float = 2.0, bufferSize: int = 30,
+                 scale: float = 0.5, quality: Optional[int] = 60,
+                 threshold: int = 0, dropUnchanged: bool = False) -> None:
+        """
+        Args:
+            fps (float): target capture rate
+            bufferSize (int): frames kept in the ring buffer
+            scale, quality: see AsyncClient.capture
+            threshold (int): hash distance up to which frames count as unchanged
+            dropUnchanged (bool): do not deliver unchanged frames
+        """
+        self._client = client
+        self.interval = 1.0 / fps
+        self.scale = scale
+        self.quality = quality
+        self.threshold = threshold
+        self.dropUnchanged = dropUnchanged
+
+        self.ring = deque(maxlen=bufferSize)
+        self.captured = 0
+        self.delivered = 0
+        self.skipped = 0
+
+        self.__latest: Optional[Frame] = None
+        self.__ready = asyncio.Event()
+        self.__producer = None
+        self.__error = None
+        self.__closed = False
+
+
+    def recent(self) -> List[Frame]:
+        """ frames in the ring buffer, oldest first """
+        return list(self.ring)
+
+
+    def __aiter__(self):
+        if self.__producer is None:
+            self.__producer = asyncio.ensure_future(self.__produce())
+        return self
+
+
+    async def __anext__(self) -> Frame:
+        while True:
+            if self.__closed:
+                raise StopAsyncIteration
+            # every call after a failure raises it, the producer is gone
+            if self.__error is not None:
+                raise self.__error
+            await self.__ready.wait()
+            self.__ready.clear()
+            frame, self.__latest = self.__latest, None
+            if frame is None:
+                continue
+            self.delivered += 1
+            return frame
+
+
+    async def aclose(self):
+        self.__closed = True
+        self.__ready.set()
+        if self.__producer is not None:
+            self.__producer.cancel()
+            try :
+                await self.__producer
+            except asyncio.CancelledError :
+                pass
+
+
+    async def __produce(self):
+        lastHash = None
+        nextTime = time.monotonic()
+        loop = asyncio.get_event_loop()
+        try :
+            while not self.__closed:
+                try :
+                    with priority(Priority.BACKGROUND):
+                        cap = await self._client.capture(self.scale, self.quality)
+                except StaleRequestError :
+                    continue
+                # decoding the image would stall the event loop
+                frameHash = await loop.run_in_executor(None, perceptualHash, cap.data)
+                changed = lastHash is None or hammingDistance(frameHash, lastHash) > self.threshold
+                lastHash = frameHash
+
+                frame = Frame(self.captured, time.time(), cap.data, cap.format, frameHash, changed)
+                self.captured += 1
+                self.ring.append(frame)
+                if changed or not self.dropUnchanged:
+                    if self.__latest is not None:
+                        self.skipped += 1
+                    self.__latest = frame
+                    self.__ready.set()
+
+                nextTime += self.interval
+                delay = nextTime - time.monotonic()
+                if delay < 0:
+                    # capture is slower than the target rate, do not try to catch up
+                    nextTime = time.monotonic()
+                    delay = 0
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError :
+            raise
+        except Exception as e :
+            logger.warning("frame capture stopped: %s", e)
+            self.__error = e
+            self.__ready.set()
@@ -0,0 +1,307 @@
+
+from array import array
+import bisect
+from functools import cached_property
+import hashlib
+import re
+import sys
+from typing import Dict, Iterable, Iterator, List, Union
+from lxml import etree
+
+
+from .spatial import GridIndex
+
+
+
+# boolean attributes of a node, bit i of NodeTable.flags is FLAG_ATTRS[i]
+FLAG_ATTRS = ("checkable", "checked", "clickable", "enabled", "focusable",
+              "focused", "scrollable", "long-clickable", "password",
+              "selected", "visible-to-user")
+
+_FLAG_BITS = {name: 1 << i for i, name in enumerate(FLAG_ATTRS)}
+
+# old dumps have no visible-to-user attribute, their nodes are all visible
+_FLAG_DEFAULTS = {"visible-to-user": "true"}
+
+# XPathSelector.position() accepts elements whose bounds scaled by this contain the point
+POSITION_SCALE = 1.5
+
+_BOUNDS_RE = re.compile(r'\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]')
+
+
+
+def _safeXmlstr(s):
+    return s.replace("$", "-")
+
+
+def _str2bytes(v) -> bytes:
+    if isinstance(v, bytes):
+        return v
+    return v.encode('utf-8')
+
+
+
+class Hierarchy(object) :
+    """
+    Parsed window hierarchy, shared by all queries against one dump
+
+    The tree is parsed once and every <node> tag is rewritten to its class
+    name, so xpath like //android.widget.TextView can be used directly.
+    Every element gets its document order index as a stable identity
+    """
+
+    def __init__(self, source: Union[str, bytes]) -> None:
+        data = _str2bytes(source)
+        self.source = source
+        self.fingerprint = hashlib.md5(data).hexdigest()
+        self.root = etree.fromstring(data)
+
+        # keep the element proxies alive, lxml returns the same object for a node then
+        self.nodes = list(self.root.iter())
+        self.classNames = [None] * len(self.nodes)
+        self.__indexes = {}
+        for index, node in enumerate(self.nodes):
+            self.__indexes[node] = index
+            if node.tag == 'node':
+                className = node.attrib.pop("class", "")
+                self.classNames[index] = className
+                node.tag = _safeXmlstr(className) or "node"
+
+
+    def __repr__(self):
+        return f"<Hierarchy {self.fingerprint}>"
+
+
+    def indexOf(self, elem) -> int:
+        """
+        Returns:
+            document order index of the element
+        """
+        return self.__indexes[elem]
+
+
+    @property
+    def rotation(self) -> int:
+        return int(self.root.attrib.get('rotation', 0))
+
+
+    @cached_property
+    def table(self) -> 'NodeTable':
+        """ columnar node table, built on first access """
+        return NodeTable(self)
+
+
+    @cached_property
+    def spatial(self) -> GridIndex:
+        """ grid index over node bounds keyed by document order index """
+        table = self.table
+        rows = [i for i in range(table.size) if table.classNames[i] is not None]
+        return GridIndex(((i, table.getBounds(i)) for i in rows), scale=POSITION_SCALE)
+
+
+    @cached_property
+    def attrIndex(self) -> 'AttributeIndex':
+        """ text / content-desc / resource-id index, built on first access """
+        return AttributeIndex(self.table)
+
+
+
+class NodeTable(object) :
+    """
+    Columnar view of a Hierarchy, row i is the element Hierarchy.nodes[i]
+
+    Built in one pass: integer bounds, interned class/resource-id/package,
+    flag bitsets and parent/child links, so attribute access needs neither
+    lxml nor regex
+    """
+
+    def __init__(self, hierarchy: Hierarchy) -> None:
+        nodes = hierarchy.nodes
+        size = len(nodes)
+        indexOf = hierarchy.indexOf
+
+        self.size = size
+        self.bounds = array('i', bytes(4 * size * array('i').itemsize))
+        self.flags = array('I', bytes(size * array('I').itemsize))
+        self.parents = array('i', [-1]) * size
+        self.firstChilds = array('i', [-1]) * size
+        self.nextSiblings = array('i', [-1]) * size
+        self.childCounts = array('i', bytes(size * array('i').itemsize))
+        self.indexes = array('i', bytes(size * array('i').itemsize))
+        self.classNames = [sys.intern(name) if name else name for name in hierarchy.classNames]
+        self.resourceIds = [None] * size
+        self.packages = [None] * size
+        self.texts = [None] * size
+        self.descriptions = [None] * size
+        self.__infos = {}
+
+        lastChilds = {}
+        for i, node in enumerate(nodes):
+            parent = node.getparent()
+            if parent is not None:
+                p = indexOf(parent)
+                self.parents[i] = p
+                self.childCounts[p] += 1
+                last = lastChilds.get(p)
+                if last is None:
+                    self.firstChilds[p] = i
+                else:
+                    self.nextSiblings[last] = i
+                lastChilds[p] = i
+
+            if self.classNames[i] is None:
+                continue
+
+            attrib = node.attrib
+            m = _BOUNDS_RE.match(attrib.get('bounds', ''))
+            if m:
+                self.bounds[4 * i:4 * i + 4] = array('i', map(int, m.groups()))
+            flags = 0
+            for name, bit in _FLAG_BITS.items():
+                if attrib.get(name, _FLAG_DEFAULTS.get(name)) == 'true':
+                    flags |= bit
+            self.flags[i] = flags
+            self.indexes[i] = int(attrib.get('index') or 0)
+            self.resourceIds[i] = sys.intern(attrib.get('resource-id', ''))
+            self.packages[i] = sys.intern(attrib.get('package', ''))
+            self.texts[i] = attrib.get('text')
+            self.descriptions[i] = attrib.get('content-desc')
+
+
+    def getBounds(self, i: int):
+        """
+        Returns:
+            tuple of (left, top, right, bottom)
+        """
+        return tuple(self.bounds[4 * i:4 * i + 4])
+
+
+    def hasFlag(self, i: int, name: str) -> bool:
+        return bool(self.flags[i] & _FLAG_BITS[name])
+
+
+    def children(self, i: int) -> Iterator[int]:
+        child = self.firstChilds[i]
+        while child != -1:
+            yield child
+            child = self.nextSiblings[child]
+
+
+    def info(self, i: int) -> dict:
+        """
+        Returns:
+            info dict of row i like UiObject.info, built once per row
+        """
+        info = self.__infos.get(i)
+        if info is None:
+            lx, ly, rx, ry = self.getBounds(i)
+            flags = self.flags[i]
+            info = {
+                "text": self.texts[i],
+                "className": self.classNames[i],
+                "bounds": {'left': lx, 'top': ly, 'right': rx, 'bottom': ry},
+                "contentDescription": self.descriptions[i],
+                "packageName": self.packages[i],
+                "resourceName": self.resourceIds[i],
+                "resourceId": self.resourceIds[i],
+                "childCount": self.childCounts[i],
+            }
+            for name, key in (("checkable", "checkable"), ("checked", "checked"),
+                              ("clickable", "clickable"), ("enabled", "enabled"),
+                              ("focusable", "focusable"), ("focused", "focused"),
+                              ("scrollable", "scrollable"), ("long-clickable", "longClickable"),
+                              ("selected", "selected")):
+                info[key] = bool(flags & _FLAG_BITS[name])
+            self.__infos[i] = info
+        return info
+
+
+
+class AttributeIndex(object) :
+    """
+    Inverted index of node text, content-desc and resource-id values
+
+    Maps each exact value to the document order indexes of its nodes,
+    sorted values answer starts-with and ends-with by bisect
+    """
+
+    ATTRS = ("text", "content-desc", "resource-id")
+
+    def __init__(self, table: NodeTable) -> None:
+        columns = {
+            "text": table.texts,
+            "content-desc": table.descriptions,
+            "resource-id": table.resourceIds,
+        }
+        self.__values: Dict[str, Dict[str, List[int]]] = {}
+        for attr, column in columns.items():
+            values = {}
+            for i in range(table.size):
+                if table.classNames[i] is not None and column[i] is not None:
+                    values.setdefault(column[i], []).append(i)
+            self.__values[attr] = values
+        self.__prefixes = {}
+        self.__suffixes = {}
+
+
+    def __sortedValues(self, attr: str) -> List[str]:
+        if attr not in self.__prefixes:
+            self.__prefixes[attr] = sorted(self.__values[attr])
+        return self.__prefixes[attr]
+
+    def __reversedValues(self, attr: str) -> List[str]:
+        if attr not in self.__suffixes:
+            self.__suffixes[attr] = sorted(v[::-1] for v in self.__values[attr])
+        return self.__suffixes[attr]
+
+
+    def __collect(self, attr: str, values: Iterable[str]) -> Iterator[int]:
+        table = self.__values[attr]
+        for v in values:
+            yield from table[v]
+
+
+    @staticmethod
+    def __prefixRange(values: List[str], prefix: str) -> List[str]:
+        start = bisect.bisect_left(values, prefix)
+        end = start
+        while end < len(values) and values[end].startswith(prefix):
+            end += 1
+        return values[start:end]
+
+
+    def equals(self, value: str, attrs: Iterable[str] = ATTRS) -> List[int]:
+        ids = set()
+        for attr in attrs:
+            ids.update(self.__values[attr].get(value, ()))
+        return sorted(ids)
+
+
+    def startsWith(self, prefix: str, attrs: Iterable[str] = ATTRS) -> List[int]:
+        ids = set()
+        for attr in attrs:
+            ids.update(self.__collect(attr, self.__prefixRange(self.__sortedValues(attr), prefix)))
+        return sorted(ids)
+
+
+    def endsWith(self, suffix: str, attrs: Iterable[str] = ATTRS) -> List[int]:
+        ids = set()
+        for attr in attrs:
+            found = self.__prefixRange(self.__reversedValues(attr), suffix[::-1])
+            ids.update(self.__collect(attr, (v[::-1] for v in found)))
+        return sorted(ids)
+
+
+    def contains(self, sub: str, attrs: Iterable[str] = ATTRS) -> List[int]:
+        ids = set()
+        for attr in attrs:
+            ids.update(self.__collect(attr, (v for v in self.__values[attr] if sub in v)))
+        return sorted(ids)
+
+
+    def search(self, pattern: re.Pattern, attrs: Iterable[str] = ATTRS) -> List[int]:
+        """ values where pattern.search() matches, like EXSLT re:match """
+        ids = set()
+        for attr in attrs:
+            ids.update(self.__collect(attr, (v for v in self.__values[attr] if pattern.search(v))))
+        return sorted(ids)
@@ -0,0 +1,312 @@
+
+import asyncio
+from dataclasses import dataclass
+import io
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try :
+    import numpy as np
+except ImportError :
+    np = None
+
+try :
+    from PIL import Image
+except ImportError :
+    Image = None
+
+
+from .client import AsyncClient
+from .exception import UiObjectNotFoundError
+
+
+# scores below this are never reported, whatever the threshold
+_MIN_SCORE = 0.3
+
+
+
+@dataclass
+class ImageMatch :
+    # (left, top, right, bottom) in screen pixels
+    bounds: Tuple[int, int, int, int]
+    # normalized cross correlation, 1.0 is a perfect match
+    score: float
+    # template scale which matched
+    scale: float
+
+    @property
+    def center(self) -> Tuple[int, int]:
+        """ (x, y) to pass to click() / longClick() """
+        lx, ly, rx, ry = self.bounds
+        return (lx + rx) // 2, (ly + ry) // 2
+
+
+
+def _requireNumpy():
+    if np is None or Image is None:
+        raise RuntimeError("image matching needs numpy and Pillow, pip install numpy pillow")
+
+
+def _toGray(source: Any) -> 'Image.Image':
+    """ path, image bytes, PIL image or numpy array to a grayscale PIL image """
+    if isinstance(source, (str, bytes)):
+        source = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    elif np is not None and isinstance(source, np.ndarray):
+        source = Image.fromarray(source)
+    return source.convert('L')
+
+
+def _windowSums(integral, h: int, w: int):
+    """ sums over every h x w window of the array the integral image was built from """
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+
+
+class _Frame(object) :
+    """ decoded screenshot with the per frame parts of the correlation cached """
+
+    def __init__(self, gray) -> None:
+        self.array = np.asarray(gray, dtype=np.float64)
+        self.__regions: Dict[tuple, tuple] = {}
+
+
+    def region(self, roi: Tuple[int, int, int, int]):
+        """
+        Returns:
+            (spectrum, integral, integral of squares) of the roi
+        """
+        cached = self.__regions.get(roi)
+        if cached is None:
+            lx, ly, rx, ry = roi
+            a = self.array[ly:ry, lx:rx]
+            integral = np.pad(a.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+            squares = np.pad((a * a).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+            cached = (np.fft.rfft2(a), integral, squares)
+            self.__regions[roi] = cached
+        return cached
+
+
+
+def matchTemplate(frame: _Frame, template, roi: Tuple[int, int, int, int]):
+    """
+    Normalized cross correlation of template at every position of roi
+
+    The numerator is one FFT product, window means and variances come from
+    integral images, so the cost does not grow with the template size
+
+    Returns:
+        score array of shape (roiHeight - h + 1, roiWidth - w + 1) or None
+    """
+    h, w = template.shape
+    lx, ly, rx, ry = roi
+    H, W = ry - ly, rx - lx
+    if h > H or w > W or h * w < 2:
+        return None
+
+    t = template - template.mean()
+    tNorm = np.sqrt((t * t).sum())
+    if tNorm == 0:
+        # a flat template matches every flat area equally
+        return None
+
+    spectrum, integral, squares = frame.region(roi)
+    # circular convolution with the flipped template, the valid part never wraps
+    kernel = np.fft.rfft2(t[::-1, ::-1], s=(H, W))
+    numerator = np.fft.irfft2(spectrum * kernel, s=(H, W))[h - 1:, w - 1:]
+
+    sums = _windowSums(integral, h, w)
+    variance = _windowSums(squares, h, w) - sums * sums / (h * w)
+    denominator = np.sqrt(np.maximum(variance, 0)) * tNorm
+    scores = np.zeros_like(numerator)
+    np.divide(numerator, denominator, out=scores, where=denominator > 1e-6 * tNorm)
+    return scores
+
+
+
+class ImageLocator(object) :
+    """
+    Locate templates on the screen, for views missing from the hierarchy
+
+    The current screenshot is decoded once and shared by every match until
+    an input action or maxAge makes it stale:
+
+        m = await d.image.match("button.png", roi=(0, 0.5, 1, 1))
+        if m:
+            await d.click(*m.center)
+        await d.image.click("ok.png", timeout=10)
+    """
+
+    def __init__(self, client: AsyncClient) -> None:
+        self._client = client
+        self.__frame: Optional[_Frame] = None
+        # (input generation, monotonic time) of the frame
+        self.__frameKey = None
+        self.__templates: Dict[Any, Any] = {}
+
+
+    def invalidate(self):
+        self.__frame = None
+
+
+    async def frame(self, maxAge: Optional[float] = None) -> _Frame:
+        """
+        Args:
+            maxAge (float): max age in seconds of the cached frame,
+                default config['hierarchy_cache_ttl'], 0 means always capture
+        """
+        _requireNumpy()
+        if maxAge is None:
+            maxAge = self._client.config['hierarchy_cache_ttl']
+        generation = self._client.inputGeneration
+        if self.__frame is not None:
+            gen, capturedAt = self.__frameKey
+            if gen == generation and time.monotonic() - capturedAt <= maxAge:
+                return self.__frame
+
+        startTime = time.monotonic()
+        data = await self._client.screenshot()
+        loop = asyncio.get_event_loop()
+        frame = await loop.run_in_executor(None, lambda: _Frame(_toGray(data)))
+        if generation == self._client.inputGeneration:
+            self.__frame, self.__frameKey = frame, (generation, startTime)
+        return frame
+
+
+    def __template(self, template: Any, scale: float):
+        key = (id(template) if not isinstance(template, (str, bytes)) else template, scale)
+        array = self.__templates.get(key)
+        if array is None:
+            gray = _toGray(template)
+            if scale != 1.0:
+                width, height = gray.size
+                gray = gray.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+            array = np.asarray(gray, dtype=np.float64)
+            if isinstance(template, (str, bytes)):
+                self.__templates[key] = array
+        return array
+
+
+    @staticmethod
+    def __roi(roi, shape) -> Tuple[int, int, int, int]:
+        height, width = shape
+        if roi is None:
+            return 0, 0, width, height
+        lx, ly, rx, ry = roi
+        if all(0 <= v <= 1 for v in roi) and any(isinstance(v, float) for v in roi):
+            lx, rx = lx * width, rx * width
+            ly, ry = ly * height, ry * height
+        lx, rx = max(0, int(lx)), min(width, int(rx))
+        ly, ry = max(0, int(ly)), min(height, int(ry))
+        return lx, ly, max(lx, rx), max(ly, ry)
+
+
+    def __search(self, frame: _Frame, template, threshold: float, scales: Iterable[float],
+                 roi, limit: int) -> List[ImageMatch]:
+        roi = self.__roi(roi, frame.array.shape)
+        found = []
+        for scale in scales:
+            t = self.__template(template, scale)
+            scores = matchTemplate(frame, t, roi)
+            if scores is None:
+                continue
+            h, w = t.shape
+            # greedy peaks, suppressing the template area around each one
+            for _ in range(limit):
+                y, x = np.unravel_index(np.argmax(scores), scores.shape)
+                score = float(scores[y, x])
+                if score < max(threshold, _MIN_SCORE):
+                    break
+                left, top = roi[0] + int(x), roi[1] + int(y)
+                found.append(ImageMatch((left, top, left + w, top + h), score, scale))
+                scores[max(0, y - h + 1):y + h, max(0, x - w + 1):x + w] = -1
+
+        # across scales keep the best of overlapping matches
+        found.sort(key=lambda m: -m.score)
+        kept = []
+        for m in found:
+            cx, cy = m.center
+            if any(k.bounds[0] <= cx < k.bounds[2] and k.bounds[1] <= cy < k.bounds[3] for k in kept):
+                continue
+            kept.append(m)
+        return kept[:limit]
+
+
+    async def matchAll(self, template: Any, threshold: float = 0.9,
+                       scales: Iterable[float] = (1.0,), roi: Optional[tuple] = None,
+                       limit: int = 10, maxAge: Optional[float] = None) -> List[ImageMatch]:
+        """
+        Args:
+            template: image path, image bytes, PIL image or numpy array
+            threshold (float): min normalized cross correlation, 0 .. 1
+            scales: template scales to try, e.g. (0.8, 1.0, 1.25)
+            roi: (left, top, right, bottom) in pixels, or floats 0 .. 1 relative to the screen
+            limit (int): max number of matches
+            maxAge (float): see frame()
+
+        Returns:
+            matches sorted by score, best first
+        """
+        frame = await self.frame(maxAge)
+        scales = tuple(scales)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.__search, frame, template, threshold, scales, roi, limit)
+
+
+    async def match(self, template: Any, threshold: float = 0.9,
+                    scales: Iterable[float] = (1.0,), roi: Optional[tuple] = None,
+                    maxAge: Optional[float] = None) -> Optional[ImageMatch]:
+        """
+        Returns:
+            best match or None, see matchAll
+        """
+        found = await self.matchAll(template, threshold, scales, roi, limit=1, maxAge=maxAge)
+        return found[0] if found else None
+
+
+    async def wait(self, template: Any, timeout: Optional[float] = None,
+                   interval: float = 0.5, **kwargs: Any) -> Optional[ImageMatch]:
+        """
+        Wait until the template appears
+
+        Returns:
+            the match or None on timeout
+        """
+        timeout = timeout or self._client.config['wait_timeout']
+        deadline = time.monotonic() + timeout
+        while True:
+            m = await self.match(template, maxAge=0, **kwargs)
+            if m is not None or time.monotonic() >= deadline:
+                return m
+            await asyncio.sleep(min(interval, max(0, deadline - time.monotonic())))
+
+
+    async def click(self, template: Any, timeout: Optional[float] = None, **kwargs: Any) -> ImageMatch:
+        """
+        Raises:
+            UiObjectNotFoundError
+        """
+        m = await self.__require(template, timeout, kwargs)
+        await self._client.click(*m.center)
+        return m
+
+
+    async def longClick(self, template: Any, timeout: Optional[float] = None,
+                        duration: float = 0.5, **kwargs: Any) -> ImageMatch:
+        """
+        Raises:
+            UiObjectNotFoundError
+        """
+        m = await self.__require(template, timeout, kwargs)
+        await self._client.longClick(*m.center, duration=duration)
+        return m
+
+
+    async def __require(self, template: Any, timeout: Optional[float], kwargs: dict) -> ImageMatch:
+        if timeout == 0:
+            m = await self.match(template, **kwargs)
+        else:
+            m = await self.wait(template, timeout, **kwargs)
+        if m is None:
+            data = template if isinstance(template, str) else type(template).__name__
+            raise UiObjectNotFoundError({'code': -32002, 'message': 'image not found', 'data': data}, 'image')
+        return m
@@ -0,0 +1,211 @@
+
+import re
+from typing import Callable, Dict, List, Optional
+
+
+from .hierarchy import Hierarchy, NodeTable
+
+
+
+def _fullmatch(pattern: str, value: Optional[str]) -> bool:
+    # java String.matches
+    return value is not None and re.fullmatch(pattern, value) is not None
+
+
+def _column(name: str) -> Callable[[NodeTable, int], Optional[str]]:
+    # the dump writes "" where the device has null, which no selector matches
+    return lambda table, i: getattr(table, name)[i] or None
+
+
+_TEXT = _column('texts')
+_DESC = _column('descriptions')
+_CLASS = _column('classNames')
+_PACKAGE = _column('packages')
+_RESOURCE_ID = _column('resourceIds')
+
+
+# Selector field -> (column getter, test)
+_STRING_FIELDS = {
+    "text": (_TEXT, lambda v, s: s is not None and s == v),
+    "textContains": (_TEXT, lambda v, s: s is not None and v in s),
+    "textMatches": (_TEXT, lambda v, s: _fullmatch(v, s)),
+    "textStartsWith": (_TEXT, lambda v, s: s is not None and s.startswith(v)),
+    "className": (_CLASS, lambda v, s: s is not None and s == v),
+    "classNameMatches": (_CLASS, lambda v, s: _fullmatch(v, s)),
+    "description": (_DESC, lambda v, s: s is not None and s == v),
+    "descriptionContains": (_DESC, lambda v, s: s is not None and v in s),
+    "descriptionMatches": (_DESC, lambda v, s: _fullmatch(v, s)),
+    "descriptionStartsWith": (_DESC, lambda v, s: s is not None and s.startswith(v)),
+    "packageName": (_PACKAGE, lambda v, s: s is not None and s == v),
+    "packageNameMatches": (_PACKAGE, lambda v, s: _fullmatch(v, s)),
+    "resourceId": (_RESOURCE_ID, lambda v, s: s is not None and s == v),
+    "resourceIdMatches": (_RESOURCE_ID, lambda v, s: _fullmatch(v, s)),
+}
+
+# Selector field -> NodeTable flag
+_FLAG_FIELDS = {
+    "checkable": "checkable",
+    "checked": "checked",
+    "clickable": "clickable",
+    "longClickable": "long-clickable",
+    "scrollable": "scrollable",
+    "enabled": "enabled",
+    "focusable": "focusable",
+    "focused": "focused",
+    "selected": "selected",
+}
+
+_CHAIN_KEYS = ("mask", "childOrSibling", "childOrSiblingSelector")
+
+
+
+class SelectorMatcher(object) :
+    """
+    Evaluate a Selector against a Hierarchy the way UiAutomator does on device
+
+    Port of QueryController.findNodeRegularRecursive: depth first search over
+    visible nodes, child() continues below the matched node, sibling() from
+    its parent, and every selector of the chain counts its own instance
+    """
+
+    def __init__(self, hierarchy: Hierarchy) -> None:
+        self.hierarchy = hierarchy
+        self.table = hierarchy.table
+        table = self.table
+        self.__roots = [i for i in table.children(0)
+                        if table.classNames[i] is not None and table.hasFlag(i, 'visible-to-user')]
+
+
+    def __chain(self, sel: dict) -> List[dict]:
+        chain = [sel]
+        for kind, sub in zip(sel.get("childOrSibling", []), sel.get("childOrSiblingSelector", [])):
+            chain.append((kind, sub))
+        return chain
+
+
+    def __attrsMatch(self, sel: dict, i: int) -> bool:
+        table = self.table
+        for key, value in sel.items():
+            if key in _CHAIN_KEYS or key == "instance":
+                continue
+            if key in _STRING_FIELDS:
+                getter, test = _STRING_FIELDS[key]
+                if not test(value, getter(table, i)):
+                    return False
+            elif key in _FLAG_FIELDS:
+                if table.hasFlag(i, _FLAG_FIELDS[key]) != bool(value):
+                    return False
+            elif key == "index":
+                if table.indexes[i] != value:
+                    return False
+        return True
+
+
+    def __matchFor(self, sel: dict, level: int, counters: Dict[int, int], i: int) -> bool:
+        if not self.__attrsMatch(sel, i):
+            return False
+        # UiSelector.matchOrUpdateInstance
+        instance = sel.get("instance", 0)
+        count = counters.get(level, 0)
+        if instance == count:
+            return True
+        if instance > count:
+            counters[level] = count + 1
+        return False
+
+
+    def __findRecursive(self, chain, level: int, counters: Dict[int, int], i: int) -> Optional[int]:
+        table = self.table
+        sel = chain[level] if level == 0 else chain[level][1]
+        if self.__matchFor(sel, level, counters, i):
+            if level == len(chain) - 1:
+                return i
+            level += 1
+            if chain[level][0] == "sibling":
+                i = table.parents[i]
+                if i <= 0:
+                    return None
+
+        for child in table.children(i):
+            if not table.hasFlag(child, 'visible-to-user'):
+                continue
+            found = self.__findRecursive(chain, level, counters, child)
+            if found is not None:
+                return found
+        return None
+
+
+    def find(self, sel: dict, instance: Optional[int] = None) -> Optional[int]:
+        """
+        Args:
+            instance: override the instance of the last selector in the chain
+
+        Returns:
+            document order index of the matched node or None
+        """
+        chain = self.__chain(sel)
+        if instance is not None:
+            last = dict(chain[-1] if len(chain) == 1 else chain[-1][1])
+            last["instance"] = instance
+            chain[-1] = last if len(chain) == 1 else (chain[-1][0], last)
+
+        counters = {}
+        for root in self.__roots:
+            found = self.__findRecursive(chain, 0, counters, root)
+            if found is not None:
+                return found
+        return None
+
+
+    def findAll(self, sel: dict) -> List[int]:
+        """
+        Returns:
+            nodes of instance 0, 1, 2 ... of the last selector in the chain,
+            i.e. UiObject[0], UiObject[1] ...
+        """
+        if not sel.get("childOrSibling"):
+            # without a chain instances are the matches in document order
+            table = self.table
+            reachable = set(self.__roots)
+            found = []
+            for i in range(table.size):
+                if i not in reachable:
+                    continue
+                reachable.update(c for c in table.children(i) if table.hasFlag(c, 'visible-to-user'))
+                if self.__attrsMatch(sel, i):
+                    found.append(i)
+            return found
+
+        found = []
+        while True:
+            i = self.find(sel, instance=len(found))
+            if i is None:
+                return found
+            found.append(i)
+
+
+    def count(self, sel: dict) -> int:
+        """
+        Same answer as the agent's count(): with a chain it searches the
+        highest instance of the first selector which still finds a node
+        """
+        if "instance" in sel:
+            return 1 if self.find(sel) is not None else 0
+        if not sel.get("childOrSibling"):
+            return len(self.findAll(sel))
+
+        def exists(instance):
+            return self.find(dict(sel, instance=instance)) is not None
+
+        if not exists(0):
+            return 0
+        low, high = 1, 2
+        while exists(high - 1):
+            low, high = high, high * 2
+        while high > low + 1:
+            mid = (low + high) // 2
+            if exists(mid - 1):
+                low = mid
+            else:
+                high = mid
+        return low
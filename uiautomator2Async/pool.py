@@ -0,0 +1,287 @@
+
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+import httpx
+
+
+from . import AsyncDevice, connectWifi, _fixWifiAddr
+from .client import sharedTransport
+from .exception import LeaseTimeout, StaleRequestError
+from .scheduler import Priority, priority
+
+
+logger = logging.getLogger(__name__)
+
+
+IDLE = 'idle'
+LEASED = 'leased'
+DEAD = 'dead'
+
+
+
+@dataclass
+class PoolEntry :
+    addr: str
+    device: Optional[AsyncDevice] = None
+    state: str = DEAD
+    failures: int = 0
+    leases: int = 0
+    reconnects: int = 0
+    lastCheck: float = 0.0
+    lastError: Optional[str] = None
+    # evict on release, the health check failed while leased
+    evictOnRelease: bool = False
+    tags: Dict[str, Any] = field(default_factory=dict)
+
+
+
+class DevicePool(object) :
+    """
+    Owns many AsyncDevice on one event loop
+
+    A background task checks every device against /version and /info,
+    evicts agents which failed `maxFailures` checks in a row and reconnects
+    them later. Workers lease devices exclusively:
+
+        async with DevicePool() as pool:
+            await pool.add("10.0.0.5")
+            async with pool.lease() as d:
+                await d.click(0.5, 0.5)
+    """
+
+    def __init__(self, checkInterval: float = 30.0, checkTimeout: float = 5.0,
+                 maxFailures: int = 2, **httpOptions: Any) -> None:
+        """
+        Args:
+            checkInterval (float): seconds between health checks
+            checkTimeout (float): timeout of one check
+            maxFailures (int): failed checks in a row before a device is evicted
+            httpOptions: see AsyncDevice, devices share one transport by default
+        """
+        self.checkInterval = checkInterval
+        self.checkTimeout = checkTimeout
+        self.maxFailures = maxFailures
+
+        self.__ownsTransport = 'transport' not in httpOptions
+        if self.__ownsTransport:
+            httpOptions['transport'] = sharedTransport(httpOptions.pop('limits', None),
+                                                       http2=httpOptions.pop('http2', False))
+        self.__httpOptions = httpOptions
+
+        self.__entries: Dict[str, PoolEntry] = {}
+        self.__available = asyncio.Condition()
+        self.__checker = None
+        self.__waiters = 0
+        self.__leasesGranted = 0
+        self.__checks = 0
+
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+
+
+    def start(self):
+        """ start the background health check """
+        if self.__checker is None:
+            self.__checker = asyncio.ensure_future(self.__checkLoop())
+
+
+    async def close(self):
+        if self.__checker is not None:
+            self.__checker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.__checker
+            self.__checker = None
+
+        for entry in self.__entries.values():
+            await self.__drop(entry)
+        self.__entries.clear()
+        if self.__ownsTransport:
+            await self.__httpOptions['transport'].aclose()
+
+
+
+    async def add(self, addr: str, **tags: Any) -> PoolEntry:
+        """
+        Add an agent, it is connected now or by a later health check
+
+        Args:
+            addr: ip or ip:port of atx-agent
+            tags: free form values, see acquire(predicate=...)
+        """
+        url = _fixWifiAddr(addr)
+        entry = self.__entries.get(url)
+        if entry is None:
+            entry = self.__entries[url] = PoolEntry(addr=url, tags=tags)
+            await self.__reconnect(entry)
+        return entry
+
+
+    async def remove(self, addr: str):
+        entry = self.__entries.pop(_fixWifiAddr(addr), None)
+        if entry is not None:
+            await self.__drop(entry)
+
+
+    @property
+    def entries(self) -> List[PoolEntry]:
+        return list(self.__entries.values())
+
+
+
+    async def acquire(self, timeout: Optional[float] = None,
+                      predicate: Optional[Callable[[PoolEntry], bool]] = None) -> AsyncDevice:
+        """
+        Lease an idle device, the caller must release() it
+
+        Raises:
+            LeaseTimeout
+        """
+        def _pick():
+            for entry in self.__entries.values():
+                if entry.state == IDLE and (predicate is None or predicate(entry)):
+                    return entry
+            return None
+
+        async with self.__available:
+            self.__waiters += 1
+            try :
+                entry = await asyncio.wait_for(self.__available.wait_for(_pick), timeout)
+            except asyncio.TimeoutError:
+                raise LeaseTimeout("no device available in %s seconds" % timeout)
+            finally :
+                self.__waiters -= 1
+
+            entry.state = LEASED
+            entry.leases += 1
+            self.__leasesGranted += 1
+            return entry.device
+
+
+    async def release(self, device: AsyncDevice):
+        entry = self.__entryOf(device)
+        if entry is None or entry.state != LEASED:
+            return
+        if entry.evictOnRelease:
+            await self.__evict(entry, entry.lastError)
+            return
+        async with self.__available:
+            entry.state = IDLE
+            self.__available.notify_all()
+
+
+    @contextlib.asynccontextmanager
+    async def lease(self, timeout: Optional[float] = None,
+                    predicate: Optional[Callable[[PoolEntry], bool]] = None) -> AsyncIterator[AsyncDevice]:
+        device = await self.acquire(timeout, predicate)
+        try :
+            yield device
+        finally :
+            await self.release(device)
+
+
+
+    def stats(self) -> dict:
+        entries = self.__entries.values()
+        return {
+            "devices": len(self.__entries),
+            "idle": sum(1 for e in entries if e.state == IDLE),
+            "leased": sum(1 for e in entries if e.state == LEASED),
+            "dead": sum(1 for e in entries if e.state == DEAD),
+            "waiters": self.__waiters,
+            "leasesGranted": self.__leasesGranted,
+            "checks": self.__checks,
+            "reconnects": sum(e.reconnects for e in entries),
+        }
+
+
+
+    def __entryOf(self, device: AsyncDevice) -> Optional[PoolEntry]:
+        for entry in self.__entries.values():
+            if entry.device is device:
+                return entry
+        return None
+
+
+    async def __checkLoop(self):
+        while True:
+            await asyncio.sleep(self.checkInterval)
+            await self.checkAll()
+
+
+    async def checkAll(self):
+        """ run one round of health checks on every device """
+        await asyncio.gather(*[self.__check(entry) for entry in list(self.__entries.values())])
+
+
+    async def __check(self, entry: PoolEntry):
+        self.__checks += 1
+        entry.lastCheck = time.monotonic()
+        if entry.state == DEAD:
+            await self.__reconnect(entry)
+            return
+
+        device = entry.device
+        try :
+            with priority(Priority.BACKGROUND):
+                # bounds the wait for a scheduler slot too, not only the request
+                await asyncio.wait_for(device.agentVersion(timeout=self.checkTimeout), self.checkTimeout)
+                await asyncio.wait_for(device.deviceInfo(), self.checkTimeout)
+        except StaleRequestError :
+            # dropped in the queue behind input of a busy lease, says nothing about health
+            return
+        except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as e:
+            entry.failures += 1
+            entry.lastError = repr(e)
+            logger.warning("health check of %s failed: %s", entry.addr, entry.lastError)
+            if entry.failures >= self.maxFailures:
+                if entry.state == LEASED:
+                    entry.evictOnRelease = True
+                else:
+                    await self.__evict(entry, entry.lastError)
+            return
+        entry.failures = 0
+
+
+    async def __reconnect(self, entry: PoolEntry):
+        addr = entry.addr[len('http://'):]
+        device = await connectWifi(addr, **self.__httpOptions)
+        if device is None:
+            entry.lastError = "agent not reachable"
+            return
+        try :
+            await asyncio.wait_for(device.deviceInfo(), self.checkTimeout)
+        except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as e:
+            entry.lastError = repr(e)
+            await device.aclose()
+            return
+
+        async with self.__available:
+            if entry.device is not None:
+                entry.reconnects += 1
+            entry.device = device
+            entry.state = IDLE
+            entry.failures = 0
+            entry.evictOnRelease = False
+            self.__available.notify_all()
+
+
+    async def __evict(self, entry: PoolEntry, reason: Optional[str]):
+        logger.warning("evict %s: %s", entry.addr, reason)
+        await self.__drop(entry)
+
+
+    async def __drop(self, entry: PoolEntry):
+        entry.state = DEAD
+        entry.evictOnRelease = False
+        if entry.device is not None:
+            await entry.device.aclose()
@@ -1,56 +1,358 @@
 
 
+import asyncio
+from collections import defaultdict
+import contextlib
+import functools
 import hashlib
+import itertools
+import logging
 import time
-from typing import Any, List
+from typing import Any, Callable, List, Optional
 import httpx
 
 
 from .exception import JSONRPCError, RpcTimeout
+from .scheduler import Priority, RequestScheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+# upper bounds in ms of the latency histogram buckets, one more bucket for larger
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# errors of an agent which reads a batch as one malformed request
+_BATCH_REJECTED = (-32700, -32600)
+
+# methods which act on the device, scheduled as Priority.INTERACTIVE
+INTERACTIVE_METHODS = frozenset((
+    "click", "doubleClick", "longClick", "swipe", "swipePoints", "drag", "dragTo",
+    "injectInputEvent", "pressKey", "pressKeyCode", "setText", "clearTextField",
+    "performTwoPointerGesture", "performMultiPointerGesture", "gesture", "pinchIn", "pinchOut",
+    "scrollForward", "scrollBackward", "scrollTo", "scrollToBeginning", "scrollToEnd",
+    "flingForward", "flingBackward", "flingToBeginning", "flingToEnd",
+    "openNotification", "openQuickSettings", "setOrientation", "wakeUp", "sleep",
+))
+
+
+
+class RpcStats(object) :
+    """ counters and latency histogram of one JSON-RPC method """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+    def record(self, elapsed: float, status: str = 'ok'):
+        self.calls += 1
+        if status == 'error':
+            self.errors += 1
+        elif status == 'timeout':
+            self.timeouts += 1
+        self.totalTime += elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+
+        ms = elapsed * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+
+    def toDict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avgTime": self.totalTime / self.calls if self.calls else 0.0,
+            "maxTime": self.maxTime,
+            "histogram": dict(zip([str(b) for b in LATENCY_BUCKETS] + ['inf'], self.histogram)),
+        }
+
+
+
+class _JSONRpcMethod(object) :
+    """ a JSON-RPC method bound to its wrapper, one per call site """
+
+    __slots__ = ('_wrapper', 'method')
+
+    def __init__(self, wrapper: 'JSONRpcWrapper', method: str) -> None:
+        self._wrapper = wrapper
+        self.method = method
+
+
+    def __call__(self, *args: Any, http_timeout: Optional[float] = None, **kwargs: Any) -> Any:
+        params = args if args else kwargs
+        return self._wrapper._callJsonRpc(self.method, params, http_timeout)
+
 
 
 class JSONRpcWrapper(object) :
+    """
+    JSON-RPC dispatcher of one device
+
+    `wrapper.method(*args)` binds the method per call, so one wrapper can be
+    shared by any number of concurrent calls. At most `maxInflight` requests
+    are sent at the same time, the UiAutomator server serialises them anyway.
+    Slots are handed out by the device's RequestScheduler, input methods as
+    INTERACTIVE and everything else by the caller's priority tag
+    """
 
-    def __init__(self, axClient: httpx.AsyncClient) -> None:
-        self.method = None
+    def __init__(self, axClient: httpx.AsyncClient, maxInflight: int = 8, timeout: float = 60,
+                 scheduler: Optional[RequestScheduler] = None,
+                 onInput: Optional[Callable[[], None]] = None) -> None:
+        """
+        Args:
+            onInput: called after a batch which contained input methods
+        """
         self.axClient = axClient
+        self.onInput = onInput
+        self.maxInflight = maxInflight
+        self.timeout = timeout
+        self.scheduler = scheduler or RequestScheduler(maxInflight)
+        self.inflight = 0
+        self.peakInflight = 0
+        # None: unknown, False: agent rejected a batch request
+        self.batchSupported = None
+        # None: unknown, False: agent has no click(selector) / swipe(selector, ...)
+        self.selectorActionsSupported = None
+        self.__stats = defaultdict(RpcStats)
 
 
     def __getattr__(self, method):
-        self.method = method
-        return self
-    
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return _JSONRpcMethod(self, method)
 
-    def __call__(self, *args: Any, **kwargs: Any) -> Any:
-        params = args if args else kwargs
-        return self._callJsonRpc(self.method, params)
 
+    @contextlib.asynccontextmanager
+    async def _slot(self, default: Priority = Priority.QUERY):
+        """ hold one of the scheduler's request slots """
+        async with self.scheduler.slot(default=default):
+            self.inflight += 1
+            self.peakInflight = max(self.peakInflight, self.inflight)
+            try :
+                yield
+            finally :
+                self.inflight -= 1
 
 
-    async def _callJsonRpc(self, method: str, params: List = []) -> Any :
+    def _record(self, method: str, elapsed: float, status: str):
+        self.__stats[method].record(elapsed, status)
+
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            {method: {calls, errors, timeouts, avgTime, maxTime, histogram}}
+        """
+        return {method: s.toDict() for method, s in self.__stats.items()}
+
+
+    def resetStats(self):
+        self.__stats.clear()
+        self.peakInflight = self.inflight
+
+
+
+    async def _callJsonRpc(self, method: str, params: List = [], timeout: Optional[float] = None) -> Any :
+        timeout = self.timeout if timeout is None else timeout
         data = {
             "jsonrpc": "2.0",
             "id": self._jsonrpcID(method),
             "method": method,
             "params": params,
         }
-        try :
-            resp = await self.axClient.post('/jsonrpc/0', json=data, timeout=httpx.Timeout(60))
-            resp.raise_for_status()
-        except httpx.ReadTimeout :
-            raise RpcTimeout()
+        default = Priority.INTERACTIVE if method in INTERACTIVE_METHODS else Priority.QUERY
+        async with self._slot(default):
+            startTime = time.monotonic()
+            status = 'error'
+            try :
+                try :
+                    resp = await self.axClient.post('/jsonrpc/0', json=data, timeout=httpx.Timeout(timeout))
+                    resp.raise_for_status()
+                except httpx.ReadTimeout :
+                    status = 'timeout'
+                    raise RpcTimeout()
+
+                jsondata = resp.json()
+                error = jsondata.get('error')
+                if not error:
+                    status = 'ok'
+                    return jsondata.get('result')
 
+                raise JSONRPCError(error, method)
+            finally :
+                self._record(method, time.monotonic() - startTime, status)
 
-        jsondata = resp.json()
-        error = jsondata.get('error')
-        if not error:
-            return jsondata.get('result')
-        
 
-        raise JSONRPCError(error, method)
+    def batch(self) -> 'JSONRpcBatch':
+        """
+        Collect calls and send them as one JSON-RPC batch
+
+        Example:
+            async with d.jsonrpc.batch() as b:
+                text = b.getText(sel1)
+                ok = b.exist(sel2)
+            print(text.result(), ok.result())
+        """
+        return JSONRpcBatch(self)
 
 
     def _jsonrpcID(self, method):
         m = hashlib.md5()
         m.update(("%s at %f" % (method, time.time())).encode("utf-8"))
         return m.hexdigest()
+
+
+
+
+class JSONRpcBatch(object) :
+    """ see JSONRpcWrapper.batch """
+
+    def __init__(self, wrapper: JSONRpcWrapper) -> None:
+        self._wrapper = wrapper
+        self._calls = []
+        self._ids = itertools.count(1)
+
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return functools.partial(self._add, method)
+
+
+    def _add(self, method: str, *args: Any, **kwargs: Any) -> asyncio.Future:
+        params = args if args else kwargs
+        fut = asyncio.get_event_loop().create_future()
+        self._calls.append((next(self._ids), method, params, fut))
+        return fut
+
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        if type is not None:
+            for _, _, _, fut in self._calls:
+                fut.cancel()
+            self._calls = []
+            return
+        await self.flush()
+
+
+    async def flush(self):
+        """ send the collected calls, results are set on their futures """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        interactive = any(method in INTERACTIVE_METHODS for _, method, _, _ in calls)
+        try :
+            await self.__flush(calls, interactive)
+        finally :
+            if interactive and self._wrapper.onInput is not None:
+                # the screen changed, drop snapshots taken before the input
+                self._wrapper.onInput()
+
+
+    async def __flush(self, calls, interactive: bool):
+        if self._wrapper.batchSupported is not False:
+            try :
+                results = await self._sendBatch(calls, Priority.INTERACTIVE if interactive else Priority.QUERY)
+            except BaseException as e :
+                # no caller is left waiting on a future of a failed batch
+                self._fail(calls, e)
+                raise
+            if results is not None:
+                self._wrapper.batchSupported = True
+                self._resolve(calls, results)
+                return
+            logger.debug("jsonrpc batch rejected, fallback to single requests")
+            self._wrapper.batchSupported = False
+
+        await asyncio.gather(*[self._callSingle(method, params, fut)
+                               for _, method, params, fut in calls])
+
+
+    async def _sendBatch(self, calls, default: Priority = Priority.QUERY):
+        """
+        Returns:
+            the list of responses, None if the agent does not accept batches
+
+        Raises:
+            RpcTimeout, JSONRPCError, httpx.HTTPError
+        """
+        data = [{
+            "jsonrpc": "2.0",
+            "id": callID,
+            "method": method,
+            "params": params,
+        } for callID, method, params, _ in calls]
+        wrapper = self._wrapper
+        async with wrapper._slot(default):
+            startTime = time.monotonic()
+            try :
+                resp = await wrapper.axClient.post('/jsonrpc/0', json=data, timeout=httpx.Timeout(wrapper.timeout))
+            except httpx.ReadTimeout :
+                for _, method, _, _ in calls:
+                    wrapper._record(method, time.monotonic() - startTime, 'timeout')
+                raise RpcTimeout()
+            elapsed = time.monotonic() - startTime
+
+        try :
+            results = resp.json()
+        except ValueError :
+            results = None
+        if isinstance(results, list):
+            byID = {r.get('id'): r for r in results if isinstance(r, dict)}
+            for callID, method, _, _ in calls:
+                r = byID.get(callID)
+                wrapper._record(method, elapsed, 'ok' if r is not None and not r.get('error') else 'error')
+            return results
+
+        error = results.get('error') if isinstance(results, dict) else None
+        if error and error.get('code') in _BATCH_REJECTED:
+            # the agent read the array as one invalid request
+            return None
+        for _, method, _, _ in calls:
+            wrapper._record(method, elapsed, 'error')
+        resp.raise_for_status()
+        raise JSONRPCError(error or {'code': -32603, 'message': 'invalid batch response'}, 'batch')
+
+
+    @staticmethod
+    def _fail(calls, e: BaseException):
+        for _, _, _, fut in calls:
+            if fut.done():
+                continue
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+
+
+    def _resolve(self, calls, results):
+        byID = {r.get('id'): r for r in results if isinstance(r, dict)}
+        for callID, method, _, fut in calls:
+            r = byID.get(callID)
+            if r is None:
+                fut.set_exception(JSONRPCError({'code': -32603, 'message': 'missing batch response'}, method))
+            elif r.get('error'):
+                fut.set_exception(JSONRPCError(r['error'], method))
+            else:
+                fut.set_result(r.get('result'))
+
+
+    async def _callSingle(self, method, params, fut):
+        try :
+            fut.set_result(await self._wrapper._callJsonRpc(method, params))
+        except Exception as e :
+            fut.set_exception(e)
@@ -0,0 +1,206 @@
+
+import asyncio
+from collections import deque
+import contextlib
+import contextvars
+import enum
+import itertools
+import logging
+import time
+from typing import Optional
+
+
+from .exception import StaleRequestError
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class Priority(enum.IntEnum) :
+    """ request classes, lower value is served first """
+    INTERACTIVE = 0
+    QUERY = 1
+    BACKGROUND = 2
+
+
+_currentPriority: contextvars.ContextVar = contextvars.ContextVar('uiautomator2AsyncPriority', default=None)
+
+
+@contextlib.contextmanager
+def priority(level: Priority):
+    """
+    Tag the requests made inside the block, e.g. a watcher loop:
+
+        with priority(Priority.BACKGROUND):
+            await d.dumpHierarchy()
+
+    Input actions stay INTERACTIVE whatever the tag
+    """
+    token = _currentPriority.set(Priority(level))
+    try :
+        yield
+    finally :
+        _currentPriority.reset(token)
+
+
+def currentPriority(default: Priority = Priority.QUERY) -> Priority:
+    """
+    Returns:
+        the priority tagged by the caller, else default. An INTERACTIVE
+        default, i.e. an input action, is never lowered
+    """
+    tagged = _currentPriority.get()
+    if tagged is None or default == Priority.INTERACTIVE:
+        return default
+    return tagged
+
+
+
+class RequestScheduler(object) :
+    """
+    Request slots of one device, handed out by priority
+
+    At most maxInflight requests run at once. `interactiveReserve` slots are
+    only used by INTERACTIVE requests, so long polls can never take all of
+    them, and BACKGROUND requests hold at most `backgroundSlots`. A request
+    waiting longer than `aging` seconds is served as if it were one class
+    more urgent, so a busy foreground does not starve the rest
+    """
+
+    def __init__(self, maxInflight: int = 8, interactiveReserve: int = 1,
+                 backgroundSlots: int = 1, aging: float = 2.0) -> None:
+        self.maxInflight = max(1, maxInflight)
+        self.interactiveReserve = min(interactiveReserve, self.maxInflight - 1)
+        self.backgroundSlots = max(1, backgroundSlots)
+        self.aging = aging
+
+        self.inflight = 0
+        self.peakInflight = 0
+        self.__inflightByPriority = [0] * len(Priority)
+        self.__waiters = [deque() for _ in Priority]
+        self.__seq = itertools.count()
+
+        self.__granted = [0] * len(Priority)
+        self.__waitTime = [0.0] * len(Priority)
+        self.__cancelled = 0
+
+
+    def __admissible(self, level: Priority) -> bool:
+        if self.inflight >= self.maxInflight:
+            return False
+        if level != Priority.INTERACTIVE:
+            shared = self.inflight - self.__inflightByPriority[Priority.INTERACTIVE]
+            if shared >= self.maxInflight - self.interactiveReserve:
+                return False
+        if level == Priority.BACKGROUND:
+            return self.__inflightByPriority[Priority.BACKGROUND] < self.backgroundSlots
+        return True
+
+
+    def __next(self):
+        """ head waiter with the best aged priority which may run now """
+        now = time.monotonic()
+        best, bestKey = None, None
+        for level, queue in zip(Priority, self.__waiters):
+            while queue and queue[0][2].done():
+                queue.popleft()
+            if not queue or not self.__admissible(level):
+                continue
+            seq, enqueued, _ = queue[0]
+            boost = int((now - enqueued) // self.aging) if self.aging > 0 else 0
+            key = (max(0, level - boost), seq)
+            if bestKey is None or key < bestKey:
+                best, bestKey = level, key
+        return best
+
+
+    def __dispatch(self):
+        while True:
+            level = self.__next()
+            if level is None:
+                return
+            _, enqueued, waiter = self.__waiters[level].popleft()
+            self.__acquire(level, enqueued)
+            waiter.set_result(None)
+
+
+    def __acquire(self, level: Priority, enqueued: float):
+        self.inflight += 1
+        self.peakInflight = max(self.peakInflight, self.inflight)
+        self.__inflightByPriority[level] += 1
+        self.__granted[level] += 1
+        self.__waitTime[level] += time.monotonic() - enqueued
+
+
+    def __release(self, level: Priority):
+        self.inflight -= 1
+        self.__inflightByPriority[level] -= 1
+        self.__dispatch()
+
+
+    @contextlib.asynccontextmanager
+    async def slot(self, level: Optional[Priority] = None, default: Priority = Priority.QUERY):
+        """
+        Hold one request slot
+
+        Args:
+            level: priority of the request, default currentPriority(default)
+
+        Raises:
+            StaleRequestError: a queued BACKGROUND request was dropped by cancelStale()
+        """
+        level = currentPriority(default) if level is None else Priority(level)
+        enqueued = time.monotonic()
+        if not any(self.__waiters) and self.__admissible(level):
+            self.__acquire(level, enqueued)
+        else:
+            waiter = asyncio.get_event_loop().create_future()
+            self.__waiters[level].append((next(self.__seq), enqueued, waiter))
+            self.__dispatch()
+            try :
+                await waiter
+            except BaseException :
+                if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                    # granted while being cancelled
+                    self.__release(level)
+                raise
+        try :
+            yield
+        finally :
+            self.__release(level)
+
+
+    def cancelStale(self) -> int:
+        """
+        Drop queued BACKGROUND requests, their result would describe a
+        screen which no longer exists, e.g. after an input action
+
+        Returns:
+            number of dropped requests
+        """
+        queue = self.__waiters[Priority.BACKGROUND]
+        count = 0
+        while queue:
+            _, _, waiter = queue.popleft()
+            if not waiter.done():
+                waiter.set_exception(StaleRequestError("background request dropped after input"))
+                count += 1
+        self.__cancelled += count
+        return count
+
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            {inflight, peakInflight, cancelled, queued: {name: n}, granted: {name: n}, avgWait: {name: seconds}}
+        """
+        return {
+            "inflight": self.inflight,
+            "peakInflight": self.peakInflight,
+            "cancelled": self.__cancelled,
+            "queued": {p.name: sum(not w.done() for _, _, w in self.__waiters[p]) for p in Priority},
+            "granted": {p.name: self.__granted[p] for p in Priority},
+            "avgWait": {p.name: self.__waitTime[p] / self.__granted[p] if self.__granted[p] else 0.0
+                        for p in Priority},
+        }
@@ -3,11 +3,14 @@
 
 
 import asyncio
-from typing import Any
+import time
+from typing import Any, Optional, Tuple
 
-from . import utils
-from .exception import RpcTimeout, UiObjectNotFoundError
+from .exception import JSONRPCError, RpcTimeout, UiObjectNotFoundError
 from .client import AsyncClient
+from .hierarchy import Hierarchy
+from .matcher import SelectorMatcher
+from .type import Direction
 
 
 class Selector(dict):
@@ -107,26 +110,150 @@ class Selector(dict):
 
 
 
+def _isNotFound(e: JSONRPCError) -> bool:
+    return 'UiObjectNotFoundException' in '{} {}'.format(e.exception_name, e.message)
+
+
+def _notFound(sel: Selector, method: str = 'objInfo') -> UiObjectNotFoundError:
+    return UiObjectNotFoundError({'code': -32002, 'message': 'UiObjectNotFoundException', 'data': str(sel)}, method)
+
+
+
 class UiObject(object):
 
     def __init__(self, client: AsyncClient, sel: Selector) :
         self.client = client
         self.sel = sel
+        # (input generation, monotonic time, bounds) of the last lookup, see _resolveBounds
+        self.__bounds = None
         
 
 
+    def __rememberBounds(self, bounds: Tuple[int, int, int, int]):
+        self.__bounds = (self.client.inputGeneration, time.monotonic(), bounds)
+
+
+    def __cachedBounds(self) -> Optional[Tuple[int, int, int, int]]:
+        """ bounds of an earlier lookup, valid until input or config['hierarchy_cache_ttl'] """
+        if self.__bounds is None:
+            return None
+        generation, lookupTime, bounds = self.__bounds
+        if generation != self.client.inputGeneration or \
+                time.monotonic() - lookupTime > self.client.config['hierarchy_cache_ttl']:
+            return None
+        return bounds
+
+
+    async def _resolveBounds(self, timeout: Optional[float] = None) -> Tuple[int, int, int, int]:
+        """
+        Bounds for an action, from the last lookup, the snapshot or one objInfo.
+        Only waits when the element is not there yet
+
+        Raises:
+            UiObjectNotFoundError
+        """
+        bounds = self.__cachedBounds()
+        if bounds is not None:
+            return bounds
+        try :
+            return await self.bounds()
+        except UiObjectNotFoundError :
+            if timeout == 0:
+                raise
+        await self.mustWait(timeout=timeout)
+        return self.__cachedBounds() or await self.bounds()
+
+
+    async def __selectorAction(self, method: str, *args: Any) -> Tuple[bool, Any]:
+        """
+        Act on the selector in one device-side call, UiObject.click() etc.
+        The agent does not wait for the selector, it fails at once if the
+        element is not there yet
+
+        Returns:
+            (False, None) if the agent does not offer it, else (True, result)
+
+        Raises:
+            UiObjectNotFoundError
+        """
+        jsonrpc = self.client.jsonrpc
+        if jsonrpc.selectorActionsSupported is False:
+            return False, None
+        try :
+            result = await getattr(jsonrpc, method)(self.sel, *args)
+        except JSONRPCError as e :
+            if e.code in (-32601, -32602):
+                jsonrpc.selectorActionsSupported = False
+                return False, None
+            if _isNotFound(e):
+                raise _notFound(self.sel, method)
+            raise
+        # only a performed action changes the screen
+        self.client.invalidateHierarchy()
+        jsonrpc.selectorActionsSupported = True
+        return True, result
+
+
+
+    @property
+    def _local(self) -> bool:
+        """ answer read-only queries from the hierarchy snapshot, see config['local_selector'] """
+        return self.client.config['local_selector']
+
+
+    async def _findLocal(self, maxAge: Optional[float] = None) -> Tuple[Hierarchy, Optional[int]]:
+        hierarchy = await self.client.hierarchy(maxAge=maxAge)
+        found = SelectorMatcher(hierarchy).find(self.sel)
+        if found is not None:
+            self.__rememberBounds(hierarchy.table.getBounds(found))
+        return hierarchy, found
+
+
+    async def _waitLocal(self, exists: bool, timeout: float) -> bool:
+        interval = self.client.config['local_poll_interval']
+        deadline = time.monotonic() + timeout
+        while True:
+            _, found = await self._findLocal(maxAge=interval)
+            if (found is not None) == exists:
+                return True
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                return False
+            await asyncio.sleep(min(interval, remain))
+
+
+
     async def exists(self) -> Any :
-        return self.client.jsonrpc.exist(self.sel)
+        if self._local:
+            _, found = await self._findLocal()
+            return found is not None
+        return await self.client.jsonrpc.exist(self.sel)
     
     @property
     async def info(self) -> Any :
-        return self.client.jsonrpc.objInfo(self.sel)
+        if self._local:
+            hierarchy, found = await self._findLocal()
+            if found is None:
+                raise _notFound(self.sel)
+            return hierarchy.table.info(found)
+        try :
+            info = await self.client.jsonrpc.objInfo(self.sel)
+        except JSONRPCError as e :
+            if isinstance(e, UiObjectNotFoundError) or not _isNotFound(e):
+                raise
+            raise _notFound(self.sel)
+        bounds = info.get('visibleBounds') or info.get('bounds')
+        if bounds:
+            self.__rememberBounds((bounds['left'], bounds['top'], bounds['right'], bounds['bottom']))
+        return info
     
 
 
     async def wait(self, exists: bool = True, timeout: int = None) -> bool :
         if timeout is None:
             timeout = self.client.config['wait_timeout']
+        if self._local:
+            return await self._waitLocal(exists, timeout)
         waitTime = timeout + 10
 
         if exists:
@@ -153,19 +280,35 @@ class UiObject(object):
 
     async def getText(self, timeout: int = None):
         await self.mustWait(timeout=timeout)
+        if self._local:
+            return (await self.info)['text']
         return await self.client.jsonrpc.getText(self.sel)
     
 
-    async def setText(self, text, timeout=None):
-        await self.mustWait(timeout=timeout)
+    async def __textAction(self, method: str, *args: Any, timeout=None) -> Any:
+        """ call first, wait for the element only if the agent did not find it """
+        for attempt in range(2):
+            try :
+                return await getattr(self.client.jsonrpc, method)(self.sel, *args)
+            except JSONRPCError as e :
+                if not _isNotFound(e) or timeout == 0 or attempt:
+                    raise
+            finally :
+                self.client.invalidateHierarchy()
+            await self.mustWait(timeout=timeout)
+
+
+    async def setText(self, text, timeout=None, settle: bool = False):
         if not text:
-            return self.client.jsonrpc.clearTextField(self.sel)
+            ret = await self.__textAction('clearTextField', timeout=timeout)
         else:
-            return self.client.jsonrpc.setText(self.sel, text)
+            ret = await self.__textAction('setText', text, timeout=timeout)
+        if settle:
+            await self.client.waitIdle()
+        return ret
 
     async def clearText(self, timeout=None):
-        await self.mustWait(timeout=timeout)
-        return self.client.jsonrpc.clearTextField(self.sel)
+        return await self.__textAction('clearTextField', timeout=timeout)
     
 
 
@@ -175,14 +318,14 @@ class UiObject(object):
 
         Args:
             maxretry (int): max click times
-            interval (float): sleep time between clicks
+            interval (float): max time between clicks, the next check runs once the UI is idle
 
         Return:
             Bool if element is gone
         """
         await self.clickExists()
         while maxretry > 0:
-            await asyncio.sleep(interval)
+            await self.client.waitIdle(quiet=min(interval, self.client.config['idle_quiet']), timeout=interval)
             if not await self.exists():
                 return True
 
@@ -199,19 +342,42 @@ class UiObject(object):
             return False
         
 
-    async def longClick(self, duration: float = 0.5, timeout=None, offset=None) :
-        await self.mustWait(timeout=timeout)
-        x, y = self.center(offset=offset)
-        return self.client.longClick(x, y, duration=duration)
+    async def longClick(self, duration: float = 0.5, timeout=None, offset=None, settle: bool = False) :
+        x, y = self.__point(await self._resolveBounds(timeout), offset)
+        return await self.client.longClick(x, y, duration=duration, settle=settle)
 
 
-    async def click(self, timeout=None, offset=None):
-        await self.mustWait(timeout=timeout)
-        x, y = self.center(offset=offset)
-        return self.client.click(x, y)
+    async def click(self, timeout=None, offset=None, settle: bool = False):
+        """
+        One round trip when possible: the element center from the last lookup
+        or the local snapshot, else the agent's own click(selector). If the
+        element is not there yet, or with an explicit timeout or offset, the
+        bounds are resolved here, waiting up to timeout for the element
+
+        Args:
+            settle (bool): return after the UI became idle, see AsyncClient.waitIdle
+        """
+        if timeout is None and offset is None and not self._local and self.__cachedBounds() is None:
+            try :
+                done, result = await self.__selectorAction('click')
+            except UiObjectNotFoundError :
+                done = False
+            if done:
+                if settle:
+                    await self.client.waitIdle()
+                return result
+        x, y = self.__point(await self._resolveBounds(timeout), offset)
+        return await self.client.click(x, y, settle=settle)
+
+
+    @staticmethod
+    def __point(bounds, offset=None) -> Tuple[int, int]:
+        lx, ly, rx, ry = bounds
+        xoff, yoff = offset or (0.5, 0.5)
+        return lx + int((rx - lx) * xoff), ly + int((ry - ly) * yoff)
     
 
-    async def swipe(self, direction, steps=10):
+    async def swipe(self, direction, steps=10, settle: bool = False):
         """
         Performs the swipe action on the UiObject.
         Swipe from center
@@ -226,19 +392,26 @@ class UiObject(object):
         """
         assert direction in ("left", "right", "up", "down")
 
-        await self.mustWait()
-        info = await self.info
-        bounds = info.get('visibleBounds') or info.get("bounds")
-        lx, ly, rx, ry = bounds['left'], bounds['top'], bounds['right'], bounds['bottom']  # yapf: disable
+        if not self._local and self.__cachedBounds() is None:
+            try :
+                done, result = await self.__selectorAction('swipe', direction, steps)
+            except UiObjectNotFoundError :
+                done = False
+            if done:
+                if settle:
+                    await self.client.waitIdle()
+                return result
+
+        lx, ly, rx, ry = await self._resolveBounds()
         cx, cy = (lx + rx) // 2, (ly + ry) // 2
         if direction == 'up':
-            return self.client.swipe(cx, cy, cx, ly, steps=steps)
+            return await self.client.swipe(cx, cy, cx, ly, steps=steps, settle=settle)
         elif direction == 'down':
-            return self.client.swipe(cx, cy, cx, ry - 1, steps=steps)
+            return await self.client.swipe(cx, cy, cx, ry - 1, steps=steps, settle=settle)
         elif direction == 'left':
-            return self.client.swipe(cx, cy, lx, cy, steps=steps)
+            return await self.client.swipe(cx, cy, lx, cy, steps=steps, settle=settle)
         elif direction == 'right':
-            return self.client.swipe(cx, cy, rx - 1, cy, steps=steps)
+            return await self.client.swipe(cx, cy, rx - 1, cy, steps=steps, settle=settle)
 
 
     async def bounds(self):
@@ -246,6 +419,11 @@ class UiObject(object):
         Returns:
             left_top_x, left_top_y, right_bottom_x, right_bottom_y
         """
+        if self._local:
+            hierarchy, found = await self._findLocal()
+            if found is None:
+                raise _notFound(self.sel)
+            return hierarchy.table.getBounds(found)
         info = await self.info
         bounds = info.get('visibleBounds') or info.get("bounds")
         lx, ly, rx, ry = bounds['left'], bounds['top'], bounds['right'], bounds['bottom']  # yapf: disable
@@ -278,43 +456,39 @@ class UiObject(object):
     
 
     async def right(self, **kwargs):
-        def onrightof(rect1, rect2):
-            left, top, right, bottom = utils.intersect(rect1, rect2)
-            return rect2["left"] - rect1["right"] if top < bottom else -1
-
-        return self.__viewBeside(onrightof, **kwargs)
+        return await self.__viewBeside(Direction.RIGHT, **kwargs)
 
     async def left(self, **kwargs):
-        def onleftof(rect1, rect2):
-            left, top, right, bottom = utils.intersect(rect1, rect2)
-            return rect1["left"] - rect2["right"] if top < bottom else -1
-
-        return self.__viewBeside(onleftof, **kwargs)
+        return await self.__viewBeside(Direction.LEFT, **kwargs)
 
     async def up(self, **kwargs):
-        def above(rect1, rect2):
-            left, top, right, bottom = utils.intersect(rect1, rect2)
-            return rect1["top"] - rect2["bottom"] if left < right else -1
-
-        return self.__viewBeside(above, **kwargs)
+        return await self.__viewBeside(Direction.UP, **kwargs)
 
     async def down(self, **kwargs):
-        def under(rect1, rect2):
-            left, top, right, bottom = utils.intersect(rect1, rect2)
-            return rect2["top"] - rect1["bottom"] if left < right else -1
+        return await self.__viewBeside(Direction.DOWN, **kwargs)
 
-        return self.__viewBeside(under, **kwargs)
 
+    async def __viewBeside(self, direction: Direction, **kwargs):
+        """ the device resolves this element, the candidates come from one hierarchy snapshot """
+        if self._local:
+            hierarchy, node = await self._findLocal()
+            if node is None:
+                raise _notFound(self.sel)
+            rect = hierarchy.table.getBounds(node)
+        else:
+            bounds = (await self.info)["bounds"]
+            rect = (bounds['left'], bounds['top'], bounds['right'], bounds['bottom'])
+            hierarchy = await self.client.hierarchy()
+
+        instances = SelectorMatcher(hierarchy).findAll(Selector(**kwargs))
+        positions = {index: i for i, index in enumerate(instances)}
+        found = hierarchy.spatial.nearest(rect, direction, accept=positions.__contains__)
+        if found is None:
+            return None
+        sel = Selector(**kwargs)
+        sel.update_instance(positions[found])
+        return UiObject(self.client, sel)
 
-    async def __viewBeside(self, onsideof, **kwargs):
-        bounds = self.info["bounds"]
-        min_dist, found = -1, None
-        for uiObj in UiObject(self.client, Selector(**kwargs)):
-            dist = onsideof(bounds, (await uiObj.info)["bounds"])
-            if dist >= 0 and (min_dist < 0 or dist < min_dist):
-                min_dist, found = dist, uiObj
-        return found
-    
 
 
     @property
@@ -324,6 +498,7 @@ class UiObject(object):
             dimention (str): one of "vert", "vertically", "vertical", "horiz", "horizental", "horizentally"
             action (str): one of "forward", "backward", "toBeginning", "toEnd", "to"
         """
+        client = self.client
         jsonrpc = self.client.jsonrpc
         selector = self.sel
 
@@ -347,22 +522,27 @@ class UiObject(object):
                 raise ValueError("invalid prop %s" % key)
 
             async def __call__(self, max_swipes=500, **kwargs):
-                if self.action == "forward":
-                    return jsonrpc.flingForward(selector, self.vertical)
-                elif self.action == "backward":
-                    return jsonrpc.flingBackward(selector, self.vertical)
-                elif self.action == "toBeginning":
-                    return jsonrpc.flingToBeginning(selector, self.vertical,
-                                                    max_swipes)
-                elif self.action == "toEnd":
-                    return jsonrpc.flingToEnd(selector, self.vertical,
-                                              max_swipes)
+                try :
+                    if self.action == "forward":
+                        return await jsonrpc.flingForward(selector, self.vertical)
+                    elif self.action == "backward":
+                        return await jsonrpc.flingBackward(selector, self.vertical)
+                    elif self.action == "toBeginning":
+                        return await jsonrpc.flingToBeginning(selector, self.vertical,
+                                                              max_swipes)
+                    elif self.action == "toEnd":
+                        return await jsonrpc.flingToEnd(selector, self.vertical,
+                                                        max_swipes)
+                finally :
+                    client.invalidateHierarchy()
 
         return _Fling()
     
 
     @property
     async def count(self):
+        if self._local:
+            return SelectorMatcher(await self.client.hierarchy()).count(self.sel)
         return await self.client.jsonrpc.count(self.sel)
 
     async def __len__(self):
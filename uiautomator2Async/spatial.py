@@ -0,0 +1,170 @@
+
+import math
+from typing import Callable, Iterable, List, Optional, Tuple
+
+
+from .type import Direction
+
+
+# number of grid cells along the longer side of the indexed area
+GRID_CELLS = 32
+
+
+
+def _scaleRect(rect, scale: float):
+    """ scale rect (left, top, right, bottom) around its center """
+    lx, ly, rx, ry = rect
+    if scale == 1.0:
+        return rect
+    dx = (rx - lx) * (scale - 1) / 2
+    dy = (ry - ly) * (scale - 1) / 2
+    return lx - dx, ly - dy, rx + dx, ry + dy
+
+
+
+class GridIndex(object) :
+    """
+    Uniform grid over rectangles (left, top, right, bottom)
+
+    Every rect is registered in the cells covered by the rect scaled by `scale`
+    around its center, so containing(..., scale) finds rects whose scaled
+    version contains a point for any scale up to the indexed one
+    """
+
+    def __init__(self, items: Iterable[Tuple[int, tuple]], scale: float = 1.0) -> None:
+        self.scale = scale
+        self.rects = dict(items)
+
+        maxX = max([r[2] for r in self.rects.values()], default=0)
+        maxY = max([r[3] for r in self.rects.values()], default=0)
+        self.cellSize = max(16, int(math.ceil(max(maxX, maxY, 1) / GRID_CELLS)))
+        self.cols = max(maxX, 1) // self.cellSize + 1
+        self.rows = max(maxY, 1) // self.cellSize + 1
+        self.__cells = [[] for _ in range(self.cols * self.rows)]
+
+        for key, rect in self.rects.items():
+            c0, r0, c1, r1 = self.__cellRange(_scaleRect(rect, scale))
+            for row in range(r0, r1 + 1):
+                base = row * self.cols
+                for col in range(c0, c1 + 1):
+                    self.__cells[base + col].append(key)
+
+
+    def __len__(self):
+        return len(self.rects)
+
+
+    def __col(self, x) -> int:
+        return min(max(int(x // self.cellSize), 0), self.cols - 1)
+
+    def __row(self, y) -> int:
+        return min(max(int(y // self.cellSize), 0), self.rows - 1)
+
+    def __cellRange(self, rect):
+        """ cells covered by rect, edges included """
+        lx, ly, rx, ry = rect
+        return self.__col(lx), self.__row(ly), self.__col(max(lx, rx)), self.__row(max(ly, ry))
+
+
+    def __candidates(self, c0: int, r0: int, c1: int, r1: int) -> set:
+        found = set()
+        for row in range(r0, r1 + 1):
+            base = row * self.cols
+            for col in range(c0, c1 + 1):
+                found.update(self.__cells[base + col])
+        return found
+
+
+    def containing(self, x: float, y: float, scale: float = 1.0) -> List[int]:
+        """
+        Args:
+            scale (float): test against rects scaled around their center,
+                must not be larger than the indexed scale
+
+        Returns:
+            sorted keys of rects containing point (x, y), edges included
+        """
+        assert scale <= self.scale, "scale larger than indexed one"
+        col, row = self.__col(x), self.__row(y)
+        found = []
+        for key in self.__cells[row * self.cols + col]:
+            lx, ly, rx, ry = _scaleRect(self.rects[key], scale)
+            if lx <= x <= rx and ly <= y <= ry:
+                found.append(key)
+        return sorted(found)
+
+
+    def overlapping(self, rect) -> List[int]:
+        """
+        Returns:
+            sorted keys of rects which have a non-empty intersection with rect
+        """
+        lx, ly, rx, ry = rect
+        found = []
+        for key in self.__candidates(*self.__cellRange(rect)):
+            klx, kly, krx, kry = self.rects[key]
+            if max(lx, klx) < min(rx, krx) and max(ly, kly) < min(ry, kry):
+                found.append(key)
+        return sorted(found)
+
+
+    def nearest(self, rect, direction: Direction,
+                accept: Optional[Callable[[int], bool]] = None) -> Optional[int]:
+        """
+        Nearest rect beside `rect`, same rules as UiObject.left/right/up/down:
+        the rect must overlap the perpendicular extent of `rect` and lie fully
+        on the given side
+
+        Args:
+            rect: (left, top, right, bottom)
+            direction: one of Direction.LEFT/RIGHT/UP/DOWN
+            accept: optional filter of keys
+
+        Returns:
+            key of the nearest rect or None
+        """
+        lx, ly, rx, ry = rect
+        c0, r0, c1, r1 = self.__cellRange(rect)
+        cell = self.cellSize
+
+        if direction == Direction.RIGHT:
+            steps = (((c, r0, c, r1), c * cell - rx) for c in range(c1, self.cols))
+        elif direction == Direction.LEFT:
+            steps = (((c, r0, c, r1), lx - (c + 1) * cell) for c in range(c0, -1, -1))
+        elif direction == Direction.DOWN:
+            steps = (((c0, r, c1, r), r * cell - ry) for r in range(r1, self.rows))
+        elif direction == Direction.UP:
+            steps = (((c0, r, c1, r), ly - (r + 1) * cell) for r in range(r0, -1, -1))
+        else:
+            raise ValueError("Unknown direction:", direction)
+
+        # walk cells away from rect, stop once unseen rects must be farther
+        best, bestDist, seen = None, -1, set()
+        for cells, bound in steps:
+            if best is not None and bestDist < bound:
+                break
+            for key in self.__candidates(*cells) - seen:
+                seen.add(key)
+                dist = self.__distance(rect, self.rects[key], direction)
+                if dist < 0 or (best is not None and (dist, key) >= (bestDist, best)):
+                    continue
+                if accept is not None and not accept(key):
+                    continue
+                best, bestDist = key, dist
+        return best
+
+
+    @staticmethod
+    def __distance(rect1, rect2, direction: Direction) -> int:
+        lx = max(rect1[0], rect2[0])
+        ly = max(rect1[1], rect2[1])
+        rx = min(rect1[2], rect2[2])
+        ry = min(rect1[3], rect2[3])
+        if direction == Direction.RIGHT:
+            return rect2[0] - rect1[2] if ly < ry else -1
+        elif direction == Direction.LEFT:
+            return rect1[0] - rect2[2] if ly < ry else -1
+        elif direction == Direction.UP:
+            return rect1[1] - rect2[3] if lx < rx else -1
+        else:
+            return rect2[1] - rect1[3] if lx < rx else -1
@@ -14,11 +14,11 @@ class SwipeExt(object) :
         self.client = client
 
 
-    def __call__(self,
-                 direction: Union[Direction, str],
-                 scale: float = 0.9,
-                 box: Union[None, tuple] = None,
-                 **kwargs):
+    async def __call__(self,
+                       direction: Union[Direction, str],
+                       scale: float = 0.9,
+                       box: Union[None, tuple] = None,
+                       **kwargs):
         """
         Args:
             direction (str): one of "left", "right", "up", "bottom" or Direction.LEFT
@@ -29,14 +29,14 @@ class SwipeExt(object) :
         Raises:
             ValueError
         """
-        def _swipe(_from, _to):
-            self.client.swipe(_from[0], _from[1], _to[0], _to[1], **kwargs)
+        async def _swipe(_from, _to):
+            await self.client.swipe(_from[0], _from[1], _to[0], _to[1], **kwargs)
 
         if box:
             lx, ly, rx, ry = box
         else:
             lx, ly = 0, 0
-            rx, ry = self.client.windowSize()
+            rx, ry = await self.client.windowSize()
 
         width, height = rx - lx, ry - ly
 
@@ -50,12 +50,12 @@ class SwipeExt(object) :
         bottom = lx + width // 2, ry - v_offset
 
         if direction == Direction.LEFT:
-            _swipe(right, left)
+            await _swipe(right, left)
         elif direction == Direction.RIGHT:
-            _swipe(left, right)
+            await _swipe(left, right)
         elif direction == Direction.UP:
-            _swipe(center, up)  # from center to top
+            await _swipe(center, up)  # from center to top
         elif direction == Direction.DOWN:
-            _swipe(center, bottom)  # from center to bottom
+            await _swipe(center, bottom)  # from center to bottom
         else:
             raise ValueError("Unknown direction:", direction)
\ No newline at end of file
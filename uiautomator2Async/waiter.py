@@ -0,0 +1,142 @@
+
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+
+
+from .client import AsyncClient
+from .exception import StaleRequestError
+from .hierarchy import Hierarchy
+from .matcher import SelectorMatcher
+from .selector import UiObject
+from .xpath import XPathSelector, _matchIds
+
+
+logger = logging.getLogger(__name__)
+
+
+ANY = 'any'
+ALL = 'all'
+
+
+
+class _Wait(object) :
+    """ one waitAny / waitAll call """
+
+    __slots__ = ('conditions', 'mode', 'future')
+
+    def __init__(self, conditions: Sequence[Any], mode: str) -> None:
+        self.conditions = list(conditions)
+        self.mode = mode
+        self.future = asyncio.get_event_loop().create_future()
+
+
+
+class WaitEngine(object) :
+    """
+    One polling loop per device serving every pending waitAny / waitAll
+
+    Each poll takes one snapshot from AsyncClient.hierarchy(), every distinct
+    condition is evaluated once against it and all satisfied waits resolve.
+    The loop runs only while waits are pending and polls again right after
+    an input action
+    """
+
+    def __init__(self, client: AsyncClient) -> None:
+        self._client = client
+        self.__waits: List[_Wait] = []
+        self.__task: Optional[asyncio.Task] = None
+        self.polls = 0
+
+
+    @staticmethod
+    def __key(condition: Any):
+        if isinstance(condition, str):
+            return ('xpath', condition)
+        if isinstance(condition, UiObject):
+            return ('selector', json.dumps(condition.sel, sort_keys=True))
+        if isinstance(condition, XPathSelector):
+            return ('xpathSelector', id(condition))
+        raise TypeError("Unknown condition type", type(condition))
+
+
+    async def __test(self, condition: Any, hierarchy: Hierarchy) -> bool:
+        if isinstance(condition, str):
+            return any(True for _ in _matchIds(hierarchy, condition))
+        if isinstance(condition, UiObject):
+            return SelectorMatcher(hierarchy).find(condition.sel) is not None
+        return len(await condition.all(hierarchy)) > 0
+
+
+    async def wait(self, conditions: Sequence[Any], mode: str = ANY,
+                   timeout: Optional[float] = None) -> Optional[int]:
+        """
+        Args:
+            conditions: UiObject, XPathSelector or xpath strings
+            mode: ANY or ALL
+            timeout (float): seconds, default config['wait_timeout']
+
+        Returns:
+            ANY: index of the first satisfied condition, ALL: 0, None on timeout
+        """
+        for condition in conditions:
+            self.__key(condition)
+        if not conditions:
+            raise ValueError("no conditions to wait for")
+        if timeout is None:
+            timeout = self._client.config['wait_timeout']
+
+        w = _Wait(conditions, mode)
+        self.__waits.append(w)
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.ensure_future(self.__loop())
+        try :
+            return await asyncio.wait_for(asyncio.shield(w.future), timeout)
+        except asyncio.TimeoutError :
+            return None
+        finally :
+            if w in self.__waits:
+                self.__waits.remove(w)
+
+
+    async def __poll(self):
+        hierarchy = await self._client.hierarchy(maxAge=self._client.config['local_poll_interval'])
+        self.polls += 1
+        results: Dict[Any, bool] = {}
+        for w in list(self.__waits):
+            if w.future.done():
+                continue
+            satisfied = []
+            for condition in w.conditions:
+                key = self.__key(condition)
+                if key not in results:
+                    results[key] = await self.__test(condition, hierarchy)
+                satisfied.append(results[key])
+            if w.mode == ANY and any(satisfied):
+                w.future.set_result(satisfied.index(True))
+            elif w.mode == ALL and all(satisfied):
+                w.future.set_result(0)
+
+
+    async def __loop(self):
+        interval = self._client.config['local_poll_interval']
+        while self.__waits:
+            generation = self._client.inputGeneration
+            try :
+                await self.__poll()
+            except asyncio.CancelledError :
+                raise
+            except StaleRequestError :
+                pass
+            except Exception as e :
+                # fail the pending waits instead of polling a broken device
+                for w in self.__waits:
+                    if not w.future.done():
+                        w.future.set_exception(e)
+                return
+
+            if not any(not w.future.done() for w in self.__waits):
+                return
+            if generation == self._client.inputGeneration:
+                await self._client.waitInput(interval)
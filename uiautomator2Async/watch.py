@@ -2,31 +2,62 @@
 import logging
 import asyncio
 from collections import OrderedDict
+import inspect
 import time
-from typing import Callable
+from typing import Callable, Dict, List, Optional
 
 
 from .utils import inject_call
 from .client import AsyncClient
-from .xpath import XPath
+from .exception import StaleRequestError
+from .hierarchy import Hierarchy
+from .scheduler import Priority, priority
+from .xpath import XPath, XMLElement, _compileUnion, _indexQuery, _matchIds
 
 
 logger = logging.getLogger(__name__)
 
 
+# idle ticks stretch the interval by this factor up to maxInterval
+BACKOFF = 1.5
+
+
 
 class AsyncWatchContext:
 
 
     def __init__(self, client: AsyncClient,
-                 builtin: bool = False, interval: float = 2.0):
+                 builtin: bool = False, interval: float = 2.0,
+                 minInterval: Optional[float] = None, maxInterval: Optional[float] = None,
+                 cooldown: float = 0.0):
+        """
+        Args:
+            interval (float): initial seconds between checks
+            minInterval (float): interval after a change or an input action, default interval / 4
+            maxInterval (float): interval reached on an idle screen, default interval * 4
+            cooldown (float): seconds before the same rule fires again
+        """
         self._client = client
         self.__interval = interval
+        self.__minInterval = interval / 4 if minInterval is None else minInterval
+        self.__maxInterval = interval * 4 if maxInterval is None else maxInterval
+        self.__cooldown = cooldown
+        self.__cooldowns = {}
         self._callbacks = OrderedDict()
         self.__xpath_list = []
         self._xpath = XPath(client)
 
         self.__isRunning = False
+        self.__task: Optional[asyncio.Task] = None
+        # rule -> time it last fired
+        self.__trigger_time: Dict[tuple, float] = {}
+        # fingerprints of the last snapshot seen and the last one all rules were evaluated against
+        self.__lastSeen = None
+        self.__lastFingerprint = None
+        self.ticks = 0
+        self.evaluations = 0
+        # distinct xpaths of all rules, rebuilt when rules change
+        self.__plan = None
 
         if builtin:
             self.when("继续使用").click()
@@ -50,34 +81,80 @@ class AsyncWatchContext:
         self.call(lambda el : el.click())
 
 
-    def call(self, fn: Callable):
+    def call(self, fn: Callable, cooldown: Optional[float] = None):
         """
         Args:
-            fn: support args (d: Device, el: Element)
+            fn: support args (d: Device, el: Element), may be a coroutine function
                 see _run_callback function for more details
+            cooldown (float): overrides the context cooldown for this rule
         """
         xpath_list = tuple(self.__xpath_list)
         self.__xpath_list = []
         assert xpath_list, "when should be called before"
 
         self._callbacks[xpath_list] = fn
+        if cooldown is not None:
+            self.__cooldowns[xpath_list] = cooldown
+        self.__plan = None
+        self.__lastFingerprint = None
 
 
-    async def start(self):
+    def start(self):
+        """ run the watcher as a task of the running event loop until stop() """
         if self.__isRunning:
             return
-        
+
         self.__isRunning = True
+        self.__task = asyncio.ensure_future(self.__loop())
+
+
+    @property
+    def interval(self) -> float:
+        """ current seconds between checks """
+        return self.__interval
+
+
+    async def __loop(self):
         try:
-            while not self.__isRunning:
-                await self._run()
-                await asyncio.sleep(self.__interval)
+            while self.__isRunning:
+                generation = self._client.inputGeneration
+                try:
+                    with priority(Priority.BACKGROUND):
+                        changed = await self._run()
+                except asyncio.CancelledError:
+                    raise
+                except StaleRequestError:
+                    changed = False
+                except Exception as e:
+                    logger.warning("watch check failed: %s", e)
+                    changed = False
+
+                if changed:
+                    self.__interval = self.__minInterval
+                else:
+                    self.__interval = min(self.__interval * BACKOFF, self.__maxInterval)
+
+                if generation != self._client.inputGeneration or \
+                        await self._client.waitInput(self.__interval):
+                    # popups tend to follow input, let the ui react then look again
+                    self.__interval = self.__minInterval
+                    await asyncio.sleep(self.__minInterval)
         finally:
-            pass
+            # after stop() a start() may already run a new loop
+            if self.__task is asyncio.current_task():
+                self.__isRunning = False
 
 
     def stop(self):
         self.__isRunning = False
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+
+    @property
+    def running(self) -> bool:
+        return self.__isRunning
 
 
     async def __aenter__(self):
@@ -87,28 +164,70 @@ class AsyncWatchContext:
         logger.info("context closed")
         self.stop()
 
-    
+
+    def __buildPlan(self):
+        distinct = list(OrderedDict.fromkeys(xp for xpaths in self._callbacks for xp in xpaths))
+        # structural xpaths are pre-checked by one union, shorthands go to the index
+        structural = tuple(xp for xp in distinct if _indexQuery(xp) is None)
+        self.__plan = (distinct, structural, _compileUnion(structural) if structural else None)
+        return self.__plan
+
+
+    def _evaluate(self, hierarchy: Hierarchy) -> Dict[str, List[int]]:
+        """
+        Evaluate every distinct xpath of all rules once
+
+        Returns:
+            xpath -> sorted document order indexes of its matches
+        """
+        distinct, structural, union = self.__plan or self.__buildPlan()
+        skipStructural = union is not None and not union(hierarchy.root)
+
+        matches = {}
+        for xpath in distinct:
+            if skipStructural and xpath in structural:
+                matches[xpath] = []
+            else:
+                matches[xpath] = sorted(set(_matchIds(hierarchy, xpath)))
+        return matches
+
+
     async def _run(self) -> bool:
+        """
+        Returns:
+            True if the snapshot changed since the last check
+        """
         logger.debug("watch check")
-        source = await self._client.dumpHierarchy()
+        self.ticks += 1
+        hierarchy = await self._client.hierarchy()
+        changed = hierarchy.fingerprint != self.__lastSeen
+        self.__lastSeen = hierarchy.fingerprint
+        if hierarchy.fingerprint == self.__lastFingerprint:
+            return changed
+
+        self.evaluations += 1
+        matches = self._evaluate(hierarchy)
+        self.__lastFingerprint = hierarchy.fingerprint
+        now = time.time()
         for xpaths, func in self._callbacks.items():
-            ok = True
-            last_match = None
-            for xpath in xpaths:
-                sel = self._xpath(xpath, source=source)
-                if not sel.exists:
-                    ok = False
-                    break
-                last_match = sel.getLastMatch()
-                logger.debug("match: %s", xpath)
-            if ok:
-                # 全部匹配
-                logger.debug("watchContext xpath matched: %s", xpaths)
-                self._run_callback(func, last_match)
-                return True
-        return False
-    
-
-    def _run_callback(self, func, element):
-        inject_call(func, d=self._d, el=element)
-        self.__trigger_time = time.time()
+            if not all(matches[xpath] for xpath in xpaths):
+                continue
+            cooldown = self.__cooldowns.get(xpaths, self.__cooldown)
+            if now - self.__trigger_time.get(xpaths, 0.0) < cooldown:
+                # evaluate this snapshot again once the cooldown is over
+                self.__lastFingerprint = None
+                continue
+            # 全部匹配, the snapshot is stale after the callback, one rule per tick
+            logger.debug("watchContext xpath matched: %s", xpaths)
+            index = matches[xpaths[-1]][0]
+            element = XMLElement(hierarchy.nodes[index], self._xpath, hierarchy, index)
+            await self._run_callback(func, element, xpaths)
+            break
+        return changed
+
+
+    async def _run_callback(self, func, element, xpaths: tuple = ()):
+        ret = inject_call(func, d=self._client, el=element)
+        if inspect.isawaitable(ret):
+            await ret
+        self.__trigger_time[xpaths] = time.time()
@@ -1,4 +1,5 @@
 
+import copy
 import functools
 import logging
 import re
@@ -10,25 +11,25 @@ from lxml import etree
 
 from typing import Union
 from .client import AsyncClient
+from .hierarchy import POSITION_SCALE, Hierarchy
 
 
 logger = logging.getLogger(__name__)
 
 
+# max number of compiled xpath kept by _compileXPath
+XPATH_CACHE_SIZE = 1024
 
-def _safeXmlstr(s):
-    return s.replace("$", "-")
-
-
-def _str2bytes(v) -> bytes:
-    if isinstance(v, bytes):
-        return v
-    return v.encode('utf-8')
+_NAMESPACES = {"re": "http://exslt.org/regular-expressions"}
 
 
 def _stringQuote(s):
-    """ quick way to quote string """
-    return "{!r}".format(s)
+    """ XPath 1.0 string literal of s, which has no escapes """
+    if "'" not in s:
+        return "'{}'".format(s)
+    if '"' not in s:
+        return '"{}"'.format(s)
+    return "concat('{}')".format(s.replace("'", "', \"'\", '"))
 
 
 def _strictXPath(xpath: str) -> str:
@@ -40,7 +41,7 @@ def _strictXPath(xpath: str) -> str:
     elif xpath.startswith('./'):
         pass
     elif xpath.startswith('@'):
-        xpath = '//*[@resource-id={!r}]'.format(xpath[1:])
+        xpath = '//*[@resource-id={}]'.format(_stringQuote(xpath[1:]))
     elif xpath.startswith('^'):
         xpath = '//*[re:match(@text, {0}) or re:match(@content-desc, {0}) or re:match(@resource-id, {0})]'.format(
             _stringQuote(xpath))
@@ -48,14 +49,14 @@ def _strictXPath(xpath: str) -> str:
     #     key = xpath[1:]
     #     return self(self.__alias_get(key), source)
     elif xpath.startswith('%') and xpath.endswith("%"):
-        xpath = '//*[contains(@text, {0}) or contains(@content-desc, {0})]'.format(string_quote(xpath[1:-1]))
+        xpath = '//*[contains(@text, {0}) or contains(@content-desc, {0})]'.format(_stringQuote(xpath[1:-1]))
     elif xpath.startswith('%'):  # ends-with
         text = xpath[1:]
-        xpath = '//*[{0} = substring(@text, string-length(@text) - {1} + 1) or {0} = substring(@content-desc, string-length(@text) - {1} + 1)]'.format(
+        xpath = '//*[{0} = substring(@text, string-length(@text) - {1} + 1) or {0} = substring(@content-desc, string-length(@content-desc) - {1} + 1)]'.format(
             _stringQuote(text), len(text))
     elif xpath.endswith('%'):  # starts-with
         text = xpath[:-1]
-        xpath = "//*[starts-with(@text, {0}) or starts-with(@content-desc, {0})]".format(string_quote(text))
+        xpath = "//*[starts-with(@text, {0}) or starts-with(@content-desc, {0})]".format(_stringQuote(text))
     else:
         xpath = '//*[@text={0} or @content-desc={0} or @resource-id={0}]'.format(
             _stringQuote(xpath))
@@ -64,16 +65,97 @@ def _strictXPath(xpath: str) -> str:
     return xpath
 
 
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def _compileXPath(xpath: str) -> etree.XPath:
+    """
+    Compiled xpath, keyed on the user-facing shorthand (@id, ^regex, %text% ...)
+
+    Raises:
+        etree.XPathSyntaxError
+    """
+    return etree.XPath(_strictXPath(xpath), namespaces=_NAMESPACES)
+
+
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def _indexQuery(xpath: str):
+    """
+    Map a shorthand to an AttributeIndex query, see _strictXPath
+
+    Returns:
+        (method name, argument, attrs) or None for structural xpath
+    """
+    textAttrs = ("text", "content-desc")
+
+    if xpath.startswith('/') or xpath.startswith('./'):
+        return None
+    elif xpath.startswith('@'):
+        query = ('equals', xpath[1:], ("resource-id",))
+    elif xpath.startswith('^'):
+        try:
+            pattern = re.compile(xpath)
+        except re.error:
+            return None
+        # re:match also tests nodes without the attribute against ''
+        if pattern.search(''):
+            return None
+        return ('search', pattern, ("text", "content-desc", "resource-id"))
+    elif xpath.startswith('%') and xpath.endswith("%"):
+        query = ('contains', xpath[1:-1], textAttrs)
+    elif xpath.startswith('%'):
+        query = ('endsWith', xpath[1:], textAttrs)
+    elif xpath.endswith('%'):
+        query = ('startsWith', xpath[:-1], textAttrs)
+    else:
+        query = ('equals', xpath, ("text", "content-desc", "resource-id"))
+
+    # empty values also match nodes without the attribute in xpath
+    return query if query[1] else None
+
+
+def _matchIds(hierarchy: Hierarchy, xpath: str, root=None):
+    """
+    Returns:
+        document order indexes of the nodes matching xpath, in any order
+    """
+    query = _indexQuery(xpath)
+    if query is None:
+        matches = _compileXPath(xpath)(hierarchy.root if root is None else root)
+        return map(hierarchy.indexOf, matches)
+    method, arg, attrs = query
+    return getattr(hierarchy.attrIndex, method)(arg, attrs)
+
+
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def _compileUnion(xpaths: tuple) -> etree.XPath:
+    """ one expression matching the nodes of any of xpaths """
+    return etree.XPath(" | ".join(_strictXPath(xp) for xp in xpaths), namespaces=_NAMESPACES)
+
+
 class XPath(object):
 
 
     def __init__(self, client: AsyncClient) -> None:
         self.client = client
+        self.__lastHierarchy = None
 
 
     
     def __call__(self, xpath: str, source=None):
         return XPathSelector(self, xpath, source)
+
+
+    def _toHierarchy(self, source) -> Hierarchy:
+        """ parse xml source, the last parsed one is reused """
+        if isinstance(source, Hierarchy):
+            return source
+        if not isinstance(source, (str, bytes)):
+            raise TypeError("Unknown type", type(source))
+
+        hierarchy = self.__lastHierarchy
+        if hierarchy is None or hierarchy.source != source:
+            hierarchy = Hierarchy(source)
+            self.__lastHierarchy = hierarchy
+        return hierarchy
     
 
 
@@ -100,16 +182,31 @@ class XPathSelector(object):
 
     def _addXPath(self, _xpath: Union[list, tuple, str]):
         if isinstance(_xpath, str):
-            _xpath = _strictXPath(_xpath)
+            _compileXPath(_xpath)
             self._xpath_list.append(_xpath)
         elif isinstance(_xpath, (list, tuple)):
             for xp in _xpath:
-                self._xpath_list.append(_strictXPath(xp))
+                _compileXPath(xp)
+                self._xpath_list.append(xp)
         else:
             raise TypeError("Unknown type for value {}".format(_xpath))
         return self
 
 
+    def position(self, x: float, y: float):
+        """
+        Only match elements around the point
+
+        Args:
+            x, y (float): percent of window width and height
+        """
+        assert 0 < x < 1
+        assert 0 < y < 1
+        new = copy.copy(self)
+        new._position = (x, y)
+        return new
+
+
     @property
     async def exists(self):
         elms = await self.all()
@@ -124,75 +221,68 @@ class XPathSelector(object):
 
     async def all(self, source=None):
         """
+        Args:
+            source: xml string, Hierarchy or XMLElement, default current snapshot
+
         Returns:
             list of XMLElement
         """
-        xml_content = source or self._source or await self._client.dumpHierarchy()
-        self._last_source = xml_content
-
-        hierarchy = source or self._source
-
-        if hierarchy is None:
-            root = etree.fromstring(_str2bytes(xml_content))
-        elif isinstance(hierarchy, (str, bytes)):
-            root = etree.fromstring(_str2bytes(hierarchy))
-        elif isinstance(hierarchy, etree._Element):
-            root = hierarchy
+        source = source or self._source
+        if source is None:
+            hierarchy = await self._client.hierarchy()
+            root = hierarchy.root
+        elif isinstance(source, XMLElement):
+            hierarchy = source.hierarchy
+            root = source.elem
         else:
-            raise TypeError("Unknown type", type(hierarchy))
+            hierarchy = self._parent._toHierarchy(source)
+            root = hierarchy.root
+        self._last_source = source if isinstance(source, XMLElement) else hierarchy
 
-        for node in root.xpath("//node"):
-            node.tag = _safeXmlstr(node.attrib.pop("class", "")) or "node"
-
-        match_sets = []
-        for xpath in self._xpath_list:
-            matches = root.xpath(
-                xpath,
-                namespaces={"re": "http://exslt.org/regular-expressions"})
-            match_sets.append(matches)
+        match_sets = [_matchIds(hierarchy, xpath, root) for xpath in self._xpath_list]
         # find out nodes which match all xpaths
-        match_nodes = functools.reduce(lambda x, y: set(x).intersection(y),
-                                       match_sets)
-        els = [XMLElement(node, self._parent) for node in match_nodes]
+        match_ids = functools.reduce(lambda x, y: x.intersection(y),
+                                     match_sets[1:], set(match_sets[0]))
+        els = [XMLElement(hierarchy.nodes[index], self._parent, hierarchy, index)
+               for index in sorted(match_ids)]
         if not self._position:
             return els
 
-        # 中心点应控制在控件内
-        inside_els = []
+        # 中心点应控制在控件内, 偏移不应大于控件宽高的50%
         px, py = self._position
-        wsize = await self._client.windowSize()
-        for e in els:
-            lpx, lpy, rpx, rpy = e.percent_bounds(wsize=wsize)
-            # 中心点偏移百分比不应大于控件宽高的50%
-            scale = 1.5
-
-            if abs(px - (lpx + rpx) / 2) > (rpx - lpx) * .5 * scale:
-                continue
-            if abs(py - (lpy + rpy) / 2) > (rpy - lpy) * .5 * scale:
-                continue
-            inside_els.append(e)
-        return inside_els
+        w, h = await self._client.windowSize()
+        around = set(hierarchy.spatial.containing(px * w, py * h, scale=POSITION_SCALE))
+        return [e for e in els if e.index in around]
 
 
 
 
 class XMLElement(object):
-    def __init__(self, elem, parent: XPath):
-        self.elem = elem
+    """ thin view over one row of Hierarchy.table """
+
+    __slots__ = ('hierarchy', 'index', '_parent')
+
+    def __init__(self, elem, parent: XPath, hierarchy: Hierarchy, index: int = None):
+        self.hierarchy = hierarchy
+        self.index = hierarchy.indexOf(elem) if index is None else index
         self._parent = parent
-        self._client = parent.client
+
+    @property
+    def elem(self):
+        return self.hierarchy.nodes[self.index]
+
+    @property
+    def _client(self):
+        return self._parent.client
 
     def __hash__(self):
-        compared_attrs = ("text", "resource-id", "package", "content-desc")
-        values = [self.attrib.get(name) for name in compared_attrs]
-        root = self.elem.getroottree()
-        fullpath = root.getpath(self.elem)
-        fullpath = re.sub(r'\[\d+\]', '', fullpath)  # remove indexes
-        values.append(fullpath)
-        return hash(tuple(values))
+        return hash((self.hierarchy.fingerprint, self.index))
 
     def __eq__(self, value):
-        return self.__hash__() == hash(value)
+        if not isinstance(value, XMLElement):
+            return False
+        return self.index == value.index and \
+            self.hierarchy.fingerprint == value.hierarchy.fingerprint
 
     def __repr__(self):
         x, y = self.center()
@@ -201,7 +291,7 @@ class XMLElement(object):
 
 
     def __call__(self, xpath: str):
-        return XPathSelector(self._parent, xpath, self.elem)
+        return XPathSelector(self._parent, xpath, self)
 
 
     def center(self):
@@ -247,9 +337,7 @@ class XMLElement(object):
         Returns:
             tuple of (left, top, right, bottom)
         """
-        bounds = self.elem.attrib.get("bounds")
-        lx, ly, rx, ry = map(int, re.findall(r"\d+", bounds))
-        return (lx, ly, rx, ry)
+        return self.hierarchy.table.getBounds(self.index)
     
 
     @property
@@ -263,7 +351,7 @@ class XMLElement(object):
 
     @property
     def text(self):
-        return self.elem.attrib.get("text")
+        return self.hierarchy.table.texts[self.index]
 
     @property
     def attrib(self):
@@ -271,17 +359,5 @@ class XMLElement(object):
 
     @property
     def info(self):
-        ret = {}
-        for key in ("text", "focusable", "enabled", "focused", "scrollable",
-                    "selected", "clickable"):
-            ret[key] = self.attrib.get(key)
-        ret["className"] = self.elem.tag
-        lx, ly, rx, ry = self.bounds
-        ret["bounds"] = {'left': lx, 'top': ly, 'right': rx, 'bottom': ry}
-        ret["contentDescription"] = self.attrib.get("content-desc")
-        ret["longClickable"] = self.attrib.get("long-clickable")
-        ret["packageName"] = self.attrib.get("package")
-        ret["resourceName"] = self.attrib.get("resource-id")
-        ret["resourceId"] = self.attrib.get("resource-id") # this is better than resourceName
-        ret["childCount"] = len(self.elem.getchildren())
-        return ret
\ No newline at end of file
+        """ built once per element and shared, do not modify """
+        return self.hierarchy.table.info(self.index)